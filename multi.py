@@ -1,11 +1,14 @@
 # pip install aiohttp
-import asyncio, aiohttp
+import asyncio, aiohttp, os
 from collections import defaultdict
 
 MAX_PORTS = 50
 MAX_ACTIVE_CASES = 10
 CASE_CAP = 5   # 竞争时每个 case 的上限
 
+DISPATCHER = os.environ.get("DISPATCHER_URL", "http://dispatcher:8000")   # 本地压测时指向 multi_bench 的模拟 dispatcher
+POLL_SEC = float(os.environ.get("POLL_SEC", "0.4"))   # 查询 /status 的间隔（秒）
+
 class FairLimiter:
     def __init__(self, max_ports=MAX_PORTS, case_cap=CASE_CAP, max_cases=MAX_ACTIVE_CASES):
         self.max_ports = max_ports
@@ -54,12 +57,11 @@ limiter = FairLimiter()
 
 async def call_dispatcher(payload):
     """把这里换成你现有的 submit/status 逻辑即可。"""
-    DISPATCHER = "http://dispatcher:8000"
     async with aiohttp.ClientSession() as s:
         async with s.post(f"{DISPATCHER}/submit", json={"params": payload}) as r:
             jid = (await r.json())["job_id"]
         while True:
-            await asyncio.sleep(0.4)
+            await asyncio.sleep(POLL_SEC)
             async with s.post(f"{DISPATCHER}/status", json={"job_id": jid}) as r:
                 st = await r.json()
             if st["state"] == "done":
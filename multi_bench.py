@@ -0,0 +1,349 @@
+# pip install aiohttp
+# 本地模拟 dispatcher + 压测 multi.py（FairLimiter / main），不需要连真正的 dispatcher
+#   python multi_bench.py                                     # 默认场景跑一次
+#   python multi_bench.py --ports 20 --case-cap 3 --cases 30 --runtime lognorm:1.0,0.6 --fail-rate 0.01
+#   python multi_bench.py --serve 8000                        # 只起模拟 dispatcher（DISPATCHER_URL=http://127.0.0.1:8000）
+import argparse, asyncio, json, math, random, threading, time
+from collections import defaultdict
+from aiohttp import web
+
+import multi
+
+# ==== 延迟分布 ====
+def make_dist(spec, rng):
+    """"const:1.0" / "uniform:0.5,2" / "exp:1.0"（均值）/ "lognorm:1.0,0.5"（中位数, sigma），单位秒"""
+    kind, _, args = spec.partition(":")
+    a = [float(x) for x in args.split(",")] if args else []
+    if kind == "const":
+        return lambda: a[0]
+    if kind == "uniform":
+        return lambda: rng.uniform(a[0], a[1])
+    if kind == "exp":
+        return lambda: rng.expovariate(1 / a[0])
+    if kind == "lognorm":
+        return lambda: a[0] * math.exp(rng.gauss(0, a[1]))
+    raise ValueError(f"未知的分布: {spec}")
+
+# ==== 模拟 dispatcher ====
+class FakeDispatcher:
+    """
+    和真 dispatcher 一样的 /submit、/status 接口；ports 个计算端口，作业按提交顺序排队等空闲端口。
+    runtime：作业占用端口的时间；rtt：每个 HTTP 请求额外的延迟；
+    fail_rate：作业以 error 结束的概率；http_error_rate：/submit 直接返回 503 的概率。
+    """
+    def __init__(self, ports=50, runtime="exp:1.0", rtt="const:0.002", fail_rate=0.0, http_error_rate=0.0, seed=0):
+        self.ports = ports
+        self.rng = random.Random(seed)
+        self.runtime = make_dist(runtime, self.rng)
+        self.rtt = make_dist(rtt, self.rng)
+        self.fail_rate = fail_rate
+        self.http_error_rate = http_error_rate
+        self.jobs = {}
+        self.next_id = 0
+        # 统计
+        self.n_jobs = 0
+        self.n_requests = 0
+        self.busy_sec = 0.0      # 所有端口累计的忙碌时间
+        self.queue_wait = []     # 每个作业在 dispatcher 里等端口的时间
+        self.max_queue = 0
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/submit", self.submit)
+        app.router.add_post("/status", self.status)
+        app.on_startup.append(self._start_ports)
+        app.on_cleanup.append(self._stop_ports)
+        return app
+
+    async def _start_ports(self, app):
+        self.queue = asyncio.Queue()
+        self._port_tasks = [asyncio.create_task(self._port()) for _ in range(self.ports)]
+
+    async def _stop_ports(self, app):
+        for t in self._port_tasks:
+            t.cancel()
+        await asyncio.gather(*self._port_tasks, return_exceptions=True)
+
+    async def _port(self):
+        while True:
+            jid = await self.queue.get()
+            job = self.jobs[jid]
+            self.queue_wait.append(time.perf_counter() - job["submitted"])
+            job["state"] = "running"
+            dt = self.runtime()
+            await asyncio.sleep(dt)
+            self.busy_sec += dt
+            if self.rng.random() < self.fail_rate:
+                job.update(state="error", error="simulated failure")
+            else:
+                job.update(state="done", result={"loss": self.rng.random(), "params": job["params"]})
+
+    async def submit(self, request):
+        self.n_requests += 1
+        body = await request.json()
+        await asyncio.sleep(self.rtt())
+        if self.rng.random() < self.http_error_rate:
+            return web.json_response({"error": "busy"}, status=503)
+        jid = str(self.next_id)
+        self.next_id += 1
+        self.n_jobs += 1
+        self.jobs[jid] = {"state": "queued", "params": body.get("params"), "submitted": time.perf_counter()}
+        self.queue.put_nowait(jid)
+        self.max_queue = max(self.max_queue, self.queue.qsize())
+        return web.json_response({"job_id": jid})
+
+    async def status(self, request):
+        self.n_requests += 1
+        jid = (await request.json()).get("job_id")
+        await asyncio.sleep(self.rtt())
+        job = self.jobs.get(jid)
+        if job is None:
+            return web.json_response({"state": "error", "error": "unknown job"})
+        out = {"state": job["state"]}
+        if job["state"] == "done":
+            out["result"] = job["result"]
+        elif job["state"] == "error":
+            out["error"] = job["error"]
+        if job["state"] in ("done", "error"):
+            del self.jobs[jid]   # 结果取走后不再保留，长时间 --serve 不涨内存
+        return web.json_response(out)
+
+class DispatcherThread:
+    """在单独线程的事件循环里跑 FakeDispatcher，不和被测的 main() 抢同一个事件循环"""
+    def __init__(self, disp, host="127.0.0.1", port=0):
+        self.disp, self.host, self.port = disp, host, port
+        self.url = None
+        self._ready = threading.Event()
+
+    def _serve(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        runner = web.AppRunner(self.disp.app())
+        self.loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, self.host, self.port)
+        self.loop.run_until_complete(site.start())
+        self.url = f"http://{self.host}:{runner.addresses[0][1]}"
+        self._ready.set()
+        self.loop.run_forever()
+        self.loop.run_until_complete(runner.cleanup())
+        self.loop.close()
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self.url
+
+    def __exit__(self, *exc):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+# ==== 被测代码的埋点 ====
+class InstrumentedLimiter(multi.FairLimiter):
+    """FairLimiter 原样使用，只额外记录：每次 acquire 等了多久、每个 case 占用端口的 端口·秒"""
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.waits = defaultdict(list)   # case -> 每次 acquire 的等待秒数
+        self.held = defaultdict(float)   # case -> 累计占用的 端口·秒
+        self._last = {}
+
+    def _tick(self, cid, before):
+        # acquire / release 返回到这里之间没有 await，before 就是刚才这段时间里的占用数
+        now = time.perf_counter()
+        self.held[cid] += before * (now - self._last.get(cid, now))
+        self._last[cid] = now
+
+    async def acquire(self, cid):
+        t0 = time.perf_counter()
+        await super().acquire(cid)
+        self.waits[cid].append(time.perf_counter() - t0)
+        self._tick(cid, self.inflight_case[cid] - 1)
+
+    async def release(self, cid):
+        await super().release(cid)
+        self._tick(cid, self.inflight_case[cid] + 1)
+
+class _LMState:
+    def __init__(self, steps):
+        self.left, self.best = steps, None
+        self.converged = steps <= 0
+
+def install_synthetic_drivers(lm_steps, rng):
+    """把 multi.py 里占位的 BO / LM 函数换成合成的：BO 每轮出 batch 个随机点，LM 每个 seed 走 1 ~ 2*lm_steps-1 步"""
+    multi.ask_BO = lambda case_id, batch: [{"case": case_id, "x": [rng.random() for _ in range(3)]} for _ in range(batch)]
+    multi.tell_BO = lambda case_id, results: None
+    multi.bo_converged = lambda case_id: False
+    multi.select_seeds = lambda case_id, n: list(range(n))
+    multi.init_lm = lambda case_id, seed: _LMState(rng.randint(1, max(1, 2 * lm_steps - 1)))
+    multi.build_lm_step = lambda case_id, state: {"case": case_id, "left": state.left}
+
+    def lm_update(case_id, state, res):
+        state.left -= 1
+        state.converged = state.left <= 0
+        state.best = res
+        return state
+    multi.lm_update = lm_update
+    multi.commit_final = lambda case_id, bests: None
+
+def _pct(xs, q):
+    xs = sorted(xs)
+    return xs[min(int(q * len(xs)), len(xs) - 1)] if xs else float("nan")
+
+def jain(xs):
+    """Jain 公平性指数：1 表示完全平均，1/n 表示全给了一个"""
+    xs = [x for x in xs if x > 0]
+    return sum(xs) ** 2 / (len(xs) * sum(x * x for x in xs)) if xs else float("nan")
+
+# ==== 压测 ====
+def run_bench(n_cases=20, max_cases=10, bo_iters=3, bo_batch=8, lm_seeds=5, lm_steps=4,
+              ports=50, max_ports=multi.MAX_PORTS, case_cap=multi.CASE_CAP, max_active=multi.MAX_ACTIVE_CASES,
+              runtime="exp:1.0", rtt="const:0.002", fail_rate=0.0, http_error_rate=0.0,
+              poll_sec=multi.POLL_SEC, seed=0):
+    """用模拟 dispatcher 跑一次 multi.main()，返回统计结果 dict"""
+    rng = random.Random(seed)
+    disp = FakeDispatcher(ports, runtime, rtt, fail_rate, http_error_rate, seed)
+    cases = [{"case_id": f"case_{i:03d}", "bo_iters": bo_iters, "bo_batch": bo_batch, "lm_seeds": lm_seeds}
+             for i in range(n_cases)]
+    span = {}         # case -> [开始, 结束]
+    errors = {}       # case -> 失败原因
+    calls = []        # 每次成功的 call_dispatcher 的耗时（占用端口的时间）
+    call_errors = []  # 失败的 call_dispatcher（作业 error / HTTP 错误）
+    saved = {k: getattr(multi, k) for k in ("DISPATCHER", "POLL_SEC", "limiter", "call_dispatcher", "run_case",
+                                            "ask_BO", "tell_BO", "bo_converged", "select_seeds", "init_lm",
+                                            "build_lm_step", "lm_update", "commit_final")}
+    orig_call, orig_run_case = multi.call_dispatcher, multi.run_case
+
+    async def timed_call(payload):
+        t0 = time.perf_counter()
+        try:
+            res = await orig_call(payload)
+        except Exception as e:
+            call_errors.append(repr(e))
+            raise
+        calls.append(time.perf_counter() - t0)
+        return res
+
+    async def timed_run_case(case_id, **kw):
+        span[case_id] = [time.perf_counter(), None]
+        try:
+            await orig_run_case(case_id, **kw)
+        except Exception as e:
+            # 原来的 main 里一个 case 出错会让 gather 直接抛出；压测里记下来，其他 case 继续跑
+            errors[case_id] = repr(e)
+        finally:
+            span[case_id][1] = time.perf_counter()
+
+    async def drive():
+        multi.limiter = InstrumentedLimiter(max_ports, case_cap, max_active)
+        t0 = time.perf_counter()
+        await multi.main(cases, max_cases=max_cases)
+        return t0, time.perf_counter()
+
+    try:
+        with DispatcherThread(disp) as url:
+            multi.DISPATCHER, multi.POLL_SEC = url, poll_sec
+            multi.call_dispatcher, multi.run_case = timed_call, timed_run_case
+            install_synthetic_drivers(lm_steps, rng)
+            t0, t1 = asyncio.run(drive())
+        lim = multi.limiter
+    finally:
+        for k, v in saved.items():
+            setattr(multi, k, v)
+
+    wall = t1 - t0
+    waits = [w for ws in lim.waits.values() for w in ws]
+    runtime_mean = disp.busy_sec / disp.n_jobs if disp.n_jobs else float("nan")
+    starts = [s - t0 for s, _ in span.values()]
+    durations = [e - s for s, e in span.values()]
+    # 每个 case 运行期间平均占用的端口数；公平性（Jain / 最少 / 最多）只看成功的 case，
+    # 失败的 case 中途退出，占用数偏低，混进来会把最少值拉到 0
+    avg_ports = {c: lim.held[c] / (e - s) for c, (s, e) in span.items() if e > s}
+    ok_ports = [v for c, v in avg_ports.items() if c not in errors]
+    return {
+        "wall_sec": wall,
+        "evals": len(calls),
+        "failed_evals": len(call_errors),
+        "throughput": len(calls) / wall,
+        "dispatcher_util": disp.busy_sec / (ports * wall),
+        "limiter_util": sum(lim.held.values()) / (max_ports * wall),
+        "dispatcher_max_queue": disp.max_queue,
+        "dispatcher_queue_p95": _pct(disp.queue_wait, 0.95),
+        "http_requests": disp.n_requests,
+        "call_p50": _pct(calls, 0.5), "call_p95": _pct(calls, 0.95),
+        "job_runtime_mean": runtime_mean,
+        "overhead_mean": sum(calls) / len(calls) - runtime_mean if calls else float("nan"),
+        "acquire_wait_p50": _pct(waits, 0.5), "acquire_wait_p95": _pct(waits, 0.95),
+        "case_start_p50": _pct(starts, 0.5), "case_start_max": max(starts, default=float("nan")),
+        "case_time_p50": _pct(durations, 0.5), "case_time_p95": _pct(durations, 0.95),
+        "fairness_jain": jain(ok_ports),
+        "ports_per_case_min": min(ok_ports, default=float("nan")),
+        "ports_per_case_max": max(ok_ports, default=float("nan")),
+        "failed_cases": errors,
+        "leaked_active_cases": sorted(lim.active_cases),
+        "per_case": {c: {"start": span[c][0] - t0, "time": span[c][1] - span[c][0],
+                         "evals": len(lim.waits[c]), "avg_ports": avg_ports.get(c, 0.0),
+                         "acquire_wait_p95": _pct(lim.waits[c], 0.95)} for c in sorted(span)},
+    }
+
+def report(r, title=""):
+    nan = lambda x: "-" if x != x else f"{x:.2f}"
+    lines = [
+        title,
+        f"用时 {r['wall_sec']:.1f} 秒，评估 {r['evals']} 次（失败 {r['failed_evals']}），吞吐 {r['throughput']:.1f} 次/秒，"
+        f"HTTP 请求 {r['http_requests']} 次",
+        f"端口利用率：dispatcher {r['dispatcher_util']:.0%}，limiter 占用 {r['limiter_util']:.0%}；"
+        f"dispatcher 队列最长 {r['dispatcher_max_queue']}，排队 p95 {nan(r['dispatcher_queue_p95'])} 秒",
+        f"单次评估 p50 / p95：{nan(r['call_p50'])} / {nan(r['call_p95'])} 秒"
+        f"（作业本身平均 {nan(r['job_runtime_mean'])} 秒，轮询 + HTTP 开销平均 {nan(r['overhead_mean'])} 秒）",
+        f"等端口（limiter.acquire）p50 / p95：{nan(r['acquire_wait_p50'])} / {nan(r['acquire_wait_p95'])} 秒",
+        f"case 等位（main 的 Semaphore）p50 / 最长：{nan(r['case_start_p50'])} / {nan(r['case_start_max'])} 秒；"
+        f"case 用时 p50 / p95：{nan(r['case_time_p50'])} / {nan(r['case_time_p95'])} 秒",
+        f"公平性（成功的 case 运行期间平均占用端口数）：Jain {nan(r['fairness_jain'])}，"
+        f"最少 {nan(r['ports_per_case_min'])} / 最多 {nan(r['ports_per_case_max'])} 个端口",
+    ]
+    if r["failed_cases"]:
+        lines.append(f"失败的 case {len(r['failed_cases'])} 个，例如 {next(iter(r['failed_cases'].items()))}")
+    if r["leaked_active_cases"]:
+        lines.append(f"⚠️ 结束后仍占着 limiter 名额的 case：{len(r['leaked_active_cases'])} 个（没有调用 remove_case）")
+    return "\n".join(l for l in lines if l)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="模拟 dispatcher，压测 multi.py")
+    parser.add_argument("--serve", type=int, metavar="PORT", help="只起模拟 dispatcher，Ctrl+C 退出")
+    parser.add_argument("--cases", type=int, default=20)
+    parser.add_argument("--max-cases", type=int, default=10, help="main() 同时跑的 case 数")
+    parser.add_argument("--bo-iters", type=int, default=3)
+    parser.add_argument("--bo-batch", type=int, default=8)
+    parser.add_argument("--lm-seeds", type=int, default=5)
+    parser.add_argument("--lm-steps", type=int, default=4, help="每个 LM seed 平均走几步")
+    parser.add_argument("--ports", type=int, default=50, help="dispatcher 的计算端口数")
+    parser.add_argument("--max-ports", type=int, default=multi.MAX_PORTS, help="FairLimiter 的 max_ports")
+    parser.add_argument("--case-cap", type=int, default=multi.CASE_CAP)
+    parser.add_argument("--max-active", type=int, default=multi.MAX_ACTIVE_CASES, help="FairLimiter 的 max_cases")
+    parser.add_argument("--runtime", default="exp:1.0", help="作业时长分布：const:1 / uniform:0.5,2 / exp:1.0 / lognorm:1.0,0.5")
+    parser.add_argument("--rtt", default="const:0.002", help="每个 HTTP 请求的额外延迟分布")
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--http-error-rate", type=float, default=0.0)
+    parser.add_argument("--poll-sec", type=float, default=multi.POLL_SEC)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--per-case", action="store_true", help="打印每个 case 的明细")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    if args.serve:
+        disp = FakeDispatcher(args.ports, args.runtime, args.rtt, args.fail_rate, args.http_error_rate, args.seed)
+        web.run_app(disp.app(), host="127.0.0.1", port=args.serve)
+    else:
+        r = run_bench(args.cases, args.max_cases, args.bo_iters, args.bo_batch, args.lm_seeds, args.lm_steps,
+                      args.ports, args.max_ports, args.case_cap, args.max_active,
+                      args.runtime, args.rtt, args.fail_rate, args.http_error_rate, args.poll_sec, args.seed)
+        if args.json:
+            print(json.dumps(r, ensure_ascii=False, indent=2))
+        else:
+            print(report(r, f"{args.cases} 个 case（同时 {args.max_cases} 个），dispatcher {args.ports} 端口，"
+                            f"max_ports={args.max_ports} case_cap={args.case_cap}，作业时长 {args.runtime}，"
+                            f"轮询间隔 {args.poll_sec} 秒"))
+            if args.per_case:
+                for c, st in r["per_case"].items():
+                    print(f"  {c}  开始 {st['start']:6.1f}s  用时 {st['time']:6.1f}s  评估 {st['evals']:4d}  "
+                          f"平均端口 {st['avg_ports']:4.1f}  等端口 p95 {st['acquire_wait_p95']:.2f}s")
@@ -525,6 +525,19 @@ from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
 import lightgbm as lgb
 
 
+BASE_LGB_PARAMS = {
+    "objective": "regression",
+    "metric": "rmse",
+    "learning_rate": 0.05,
+    "num_leaves": 64,
+    "min_data_in_leaf": 50,
+    "feature_fraction": 0.8,
+    "bagging_fraction": 0.8,
+    "bagging_freq": 1,
+    "lambda_l2": 1.0,
+    "verbosity": -1,
+}
+
 def train_lgbm_groupkfold(
     df: pd.DataFrame,
     target_col: str = "overlay",
@@ -532,6 +545,7 @@ def train_lgbm_groupkfold(
     drop_cols=("wafer_id",),     # 你也可以加上不想喂给模型的列
     n_splits: int = 5,
     random_state: int = 42,
+    params: dict = None,         # 覆盖 BASE_LGB_PARAMS 里的项，None 时用默认
 ):
     # --- 基本清理 ---
     assert target_col in df.columns, f"missing target_col={target_col}"
@@ -560,22 +574,10 @@ def train_lgbm_groupkfold(
     gkf = GroupKFold(n_splits=n_splits)
 
     oof_pred = np.full(shape=len(df), fill_value=np.nan, dtype=float)
+    oof_fold = np.zeros(len(df), dtype=int)
     models = []
-    fold_metrics = []
-
-    params = {
-        "objective": "regression",
-        "metric": "rmse",
-        "learning_rate": 0.05,
-        "num_leaves": 64,
-        "min_data_in_leaf": 50,
-        "feature_fraction": 0.8,
-        "bagging_fraction": 0.8,
-        "bagging_freq": 1,
-        "lambda_l2": 1.0,
-        "verbosity": -1,
-        "seed": random_state,
-    }
+
+    params = {**BASE_LGB_PARAMS, "seed": random_state, **(params or {})}
 
     for fold, (tr_idx, va_idx) in enumerate(gkf.split(X, y, groups=groups), start=1):
         X_tr, y_tr = X.iloc[tr_idx], y[tr_idx]
@@ -598,13 +600,12 @@ def train_lgbm_groupkfold(
 
         pred_va = model.predict(X_va, num_iteration=model.best_iteration)
         oof_pred[va_idx] = pred_va
+        oof_fold[va_idx] = fold
         models.append(model)
 
         rmse = mean_squared_error(y_va, pred_va, squared=False)
         mae = mean_absolute_error(y_va, pred_va)
         r2 = r2_score(y_va, pred_va)
-
-        fold_metrics.append({"fold": fold, "rmse": rmse, "mae": mae, "r2": r2, "best_iter": model.best_iteration})
         print(f"[Fold {fold}] RMSE={rmse:.6f}  MAE={mae:.6f}  R2={r2:.4f}  best_iter={model.best_iteration}")
 
     # --- Overall OOF metrics ---
@@ -619,25 +620,11 @@ def train_lgbm_groupkfold(
     print("\n=== OOF Overall ===")
     print(f"RMSE={overall_rmse:.6f}  MAE={overall_mae:.6f}  R2={overall_r2:.4f}")
 
-    # --- Per-wafer metrics（很重要） ---
-    per_wafer = []
-    tmp = df[[group_col]].copy()
-    tmp["y_true"] = y
-    tmp["y_pred"] = oof_pred
-    tmp = tmp.dropna(subset=["y_pred"])
-
-    for wid, g in tmp.groupby(group_col):
-        yt = g["y_true"].to_numpy()
-        yp = g["y_pred"].to_numpy()
-        per_wafer.append({
-            group_col: wid,
-            "n": len(g),
-            "rmse": mean_squared_error(yt, yp, squared=False),
-            "mae": mean_absolute_error(yt, yp),
-            "r2": r2_score(yt, yp) if len(g) >= 3 else np.nan
-        })
-
-    per_wafer_df = pd.DataFrame(per_wafer).sort_values("rmse", ascending=False)
+    # --- Per-wafer / per-fold metrics（分组数组归约，不再 groupby + sklearn 循环）---
+    per_wafer_df = grouped_regression_metrics(y, oof_pred, groups, group_col) \
+                       .sort_values("rmse", ascending=False)
+    fold_metrics_df = grouped_regression_metrics(y, oof_pred, oof_fold, "fold")
+    fold_metrics_df["best_iter"] = [m.best_iteration for m in models]
 
     # --- 特征重要性（用最后一折的模型 or 平均）---
     # 这里给平均 gain 重要性
@@ -651,12 +638,11 @@ def train_lgbm_groupkfold(
         "importance_gain_avg": imp_gain
     }).sort_values("importance_gain_avg", ascending=False)
 
-    fold_metrics_df = pd.DataFrame(fold_metrics)
-
     return {
         "models": models,
         "feature_cols": feature_cols,
         "oof_pred": oof_pred,
+        "oof_fold": oof_fold,
         "fold_metrics": fold_metrics_df,
         "per_wafer_metrics": per_wafer_df,
         "feature_importance": feat_imp_df,
@@ -691,4 +677,1918 @@ res_y = train_lgbm_groupkfold(df, target_col="overlay_y", group_col="wafer_id",
 
 ⸻
 
-如果你愿意把你的坐标单位告诉我（mm/µm），我可以顺手把 LightGBM 参数里 min_data_in_leaf、以及你前面 leveling radius 的默认值，按你点密度给一套更贴合的推荐配置。
\ No newline at end of file
+如果你愿意把你的坐标单位告诉我（mm/µm），我可以顺手把 LightGBM 参数里 min_data_in_leaf、以及你前面 leveling radius 的默认值，按你点密度给一套更贴合的推荐配置。
+
+
+
+
+
+
+下面给你一个“多尺度 FFT 平滑”的 leveling 特征族，和前面的 lvl_knn* / lvl_rad* 思路一样（target 点附近 leveling 的均值 / tilt / 曲率），但换成 Gaussian / LoG 平滑图 + 双线性采样：
+	•	每片 wafer 只栅格化一次（网格所有 wafer 共用）
+	•	所有尺度的频域核只算一次，一次 rfft2 + 批量 irfft2 得到全部尺度
+	•	在 target (x,y) 上双线性采样，成本和 target 数基本无关
+
+kNN / 半径邻域要对每个 target × 每个尺度做一次局部拟合，尺度一多就慢得不行；FFT 版加尺度只是多几张逆变换。
+
+⸻
+
+1) 思路
+
+对每片 wafer：
+	•	把 leveling 点落到规则网格：zw = 每格均值，w = 有无数据（0/1）
+	•	归一化卷积：s = G_σ*(zw) / G_σ*(w)，无数据格子和 wafer 外部不会把平滑值拉向 0
+	•	梯度、LoG 都在频域乘 i·kx、i·ky、-(kx²+ky²) 得到，再用商的求导公式换算成 s 的梯度 / 拉普拉斯
+	•	G_σ*(w) 太小（附近没有 leveling 点）的地方直接给 NaN，LightGBM 原生支持
+
+每个尺度输出 4 列：
+	•	lvl_gs{σ}_mean：Gaussian 平滑值（≈ lvl_rad*_mean）
+	•	lvl_gs{σ}_tilt_x / lvl_gs{σ}_tilt_y：平滑面的梯度（≈ lvl_*_tilt_x/y）
+	•	lvl_gs{σ}_laplacian：LoG（≈ lvl_knn*_laplacian）
+
+⸻
+
+2) 代码（接在前面 ovl 代码后面即可，只依赖 numpy / pandas）
+
+def _next_fast_len(n):
+    """不小于 n 的最小 2^a·3^b·5^c（偶数），FFT 在这种长度上最快"""
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1 and n % 2 == 0:
+            return n
+        n += 1
+
+def _make_wafer_grid(xy_list, grid_step, pad):
+    """
+    用所有 wafer 共用的规则网格（原点对齐 wafer 中心），保证每个尺度的频域核只算一次。
+    xy_list: 若干 (n,2) 数组，用于确定覆盖范围
+    pad: 每边额外补零的长度（同坐标单位），避免 FFT 循环卷积的环绕
+    返回 (x0, y0, nx, ny)：网格左下角坐标与格点数
+    """
+    xy = np.vstack(xy_list)
+    half_data = np.abs(xy).max()
+    # 补零超过数据半宽就没有意义了（再大的核在归一化卷积里也只是趋近全局均值）
+    half = half_data + min(pad, half_data)
+    n = _next_fast_len(int(np.ceil(2 * half / grid_step)) + 1)
+    x0 = y0 = -grid_step * (n // 2)
+    return x0, y0, n, n
+
+def _rasterize(xy, z, x0, y0, nx, ny, grid_step):
+    """
+    把散点落到网格：每格取均值，返回 (zw, w)
+    zw: 每格 z 的均值（无数据为 0）
+    w : 有数据的格子为 1，否则 0
+    """
+    ix = np.clip(np.rint((xy[:,0] - x0) / grid_step).astype(int), 0, nx - 1)
+    iy = np.clip(np.rint((xy[:,1] - y0) / grid_step).astype(int), 0, ny - 1)
+    flat = iy * nx + ix
+    ok = np.isfinite(z)
+    s = np.bincount(flat[ok], weights=z[ok], minlength=nx*ny)
+    c = np.bincount(flat[ok], minlength=nx*ny).astype(float)
+    w = (c > 0).astype(float)
+    zw = np.divide(s, c, out=np.zeros_like(s), where=c > 0)
+    return zw.reshape(ny, nx), w.reshape(ny, nx)
+
+def _gaussian_transfer_stack(sigma_list, nx, ny, grid_step):
+    """
+    所有尺度的频域核一次算好：G, i*kx*G, i*ky*G, -(kx^2+ky^2)*G
+    返回 complex 数组 (n_scales, 4, ny, nx//2+1)，配合 rfft2 使用
+    """
+    kx = 2*np.pi * np.fft.rfftfreq(nx, d=grid_step)[None, :]
+    ky = 2*np.pi * np.fft.fftfreq(ny, d=grid_step)[:, None]
+    k2 = kx*kx + ky*ky
+    sig = np.asarray(sigma_list, dtype=float)[:, None, None]
+    G = np.exp(-0.5 * sig*sig * k2[None])           # (S, ny, nxr)
+    return np.stack([G, 1j*kx*G, 1j*ky*G, -k2*G], axis=1)
+
+def _fft_smooth_maps(zw, w, H, max_chunk_bytes=256 * 2**20):
+    """
+    归一化卷积（normalized convolution）：s = G*(zw) / G*(w)，
+    无数据区域和 wafer 边缘不会被 0 拉低。
+    一次 rfft2 + 批量 irfft2 得到所有尺度的 平滑值 / 梯度 / LoG；
+    尺度很多时按 max_chunk_bytes 分批，控制频域中间数组的内存。
+    返回 (maps, support)：maps (S, 4, ny, nx) = [mean, tilt_x, tilt_y, laplacian]，support (S, ny, nx) = G*w
+    """
+    F = np.fft.rfft2(np.stack([zw * w, w]))         # (2, ny, nxr)
+    ny, nx = zw.shape
+    per_scale = 8 * F[0].size * 16                  # 4 个核 × (N, D) × complex128
+    step = max(1, int(max_chunk_bytes // per_scale))
+
+    maps, support = [], []
+    for i in range(0, len(H), step):
+        # (s, 4, 2, ny, nxr) -> 一次性逆变换
+        out = np.fft.irfft2(H[i:i+step, :, None] * F[None, None], s=(ny, nx), axes=(-2, -1))
+        N, D = out[:, :, 0], out[:, :, 1]           # (s, 4, ny, nx)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            s = N[:, 0] / D[:, 0]
+            gx = (N[:, 1] - s * D[:, 1]) / D[:, 0]
+            gy = (N[:, 2] - s * D[:, 2]) / D[:, 0]
+            # ∇²(N/D) = (∇²N - s∇²D - 2∇s·∇D) / D
+            lap = (N[:, 3] - s * D[:, 3] - 2*(gx * D[:, 1] + gy * D[:, 2])) / D[:, 0]
+        maps.append(np.stack([s, gx, gy, lap], axis=1))
+        support.append(D[:, 0])
+    return np.concatenate(maps), np.concatenate(support)
+
+def _bilinear_sample(maps, xy, x0, y0, grid_step):
+    """
+    maps: (..., ny, nx)；xy: (n,2)
+    一次 gather 4 个角点，返回 (..., n)。网格外为 NaN。
+    """
+    ny, nx = maps.shape[-2:]
+    fx = (xy[:,0] - x0) / grid_step
+    fy = (xy[:,1] - y0) / grid_step
+    inside = (fx >= 0) & (fx <= nx - 1) & (fy >= 0) & (fy <= ny - 1)
+    ix = np.clip(np.floor(fx).astype(int), 0, nx - 2)
+    iy = np.clip(np.floor(fy).astype(int), 0, ny - 2)
+    tx = fx - ix
+    ty = fy - iy
+    v00 = maps[..., iy, ix];     v01 = maps[..., iy, ix + 1]
+    v10 = maps[..., iy + 1, ix]; v11 = maps[..., iy + 1, ix + 1]
+    out = (v00*(1-tx)*(1-ty) + v01*tx*(1-ty) + v10*(1-tx)*ty + v11*tx*ty)
+    return np.where(inside, out, np.nan)
+
+def build_leveling_fft_features(
+    targets_df: pd.DataFrame,
+    leveling_df: pd.DataFrame,
+    value_col: str = "z",
+    sigma_list=(2500.0, 5000.0, 10000.0, 20000.0),  # Gaussian 尺度，单位同坐标
+    grid_step: float = 1000.0,                       # 网格间距，建议 ≈ leveling 平均点距
+    min_support: float = 1e-3,                       # G*w 低于此值视为无数据 -> NaN
+):
+    """
+    多尺度 Gaussian / LoG 平滑 leveling 特征（FFT 版）。
+    每片 wafer 只栅格化一次，所有尺度在一次批量 FFT 中算完，再在 target (x,y) 双线性采样。
+    每个尺度输出：lvl_gs{σ}_mean / _tilt_x / _tilt_y / _laplacian
+    """
+    sigma_list = tuple(float(s) for s in sigma_list)
+    x0, y0, nx, ny = _make_wafer_grid(
+        [leveling_df[["x","y"]].to_numpy(), targets_df[["x","y"]].to_numpy()],
+        grid_step=grid_step, pad=3 * max(sigma_list),
+    )
+    H = _gaussian_transfer_stack(sigma_list, nx, ny, grid_step)  # 所有 wafer 共用
+    feat_names = ["mean", "tilt_x", "tilt_y", "laplacian"]
+    cols = [f"lvl_gs{s}_{n}" for s in sigma_list for n in feat_names]
+
+    lvl_groups = {wid: g for wid, g in leveling_df.groupby("wafer_id")}
+    out_rows = []
+    for wafer_id, tdf in targets_df.groupby("wafer_id"):
+        feat = tdf[["wafer_id","x","y"]].copy()
+        ldf = lvl_groups.get(wafer_id)
+        if ldf is None or len(ldf) == 0:
+            out_rows.append(feat.reindex(columns=list(feat.columns) + cols))
+            continue
+
+        zw, w = _rasterize(ldf[["x","y"]].to_numpy(), ldf[value_col].to_numpy().astype(float),
+                           x0, y0, nx, ny, grid_step)
+        maps, support = _fft_smooth_maps(zw, w, H)
+        maps = np.where(support[:, None] >= min_support, maps, np.nan)
+
+        T_xy = tdf[["x","y"]].to_numpy().astype(float)
+        vals = _bilinear_sample(maps, T_xy, x0, y0, grid_step)   # (S, 4, nT)
+        feat = pd.concat(
+            [feat, pd.DataFrame(vals.reshape(-1, len(T_xy)).T, columns=cols, index=feat.index)],
+            axis=1,
+        )
+        out_rows.append(feat)
+
+    return pd.concat(out_rows, ignore_index=True)
+
+
+⸻
+
+3) 接进 assemble_training_table
+
+加一个可选参数 fft_sigma_list，默认 None 时行为和原来完全一样：
+
+def assemble_training_table(targets_df, leveling_df, bow_df, wafer_df=None, fft_sigma_list=None):
+    lvl_feat = build_leveling_local_features(
+        targets_df=targets_df,
+        leveling_df=leveling_df,
+        value_col="z",
+        knn_list=(32,64),
+        radius_list=(5000.0,10000.0),
+        add_quad_curvature=True
+    )
+
+    bow_poly_feat = build_bow_poly_features(
+        targets_df=targets_df,
+        bow_df=bow_df,
+        degree=2,
+        ridge_alpha=1e-6,
+        value_col="z",
+        add_wafer_level_coefs=True
+    )
+
+    bow_dist_feat = build_bow_distance_features(
+        targets_df=targets_df,
+        bow_df=bow_df,
+        value_col="z",
+        knn_list=(3,5),
+        idw_power=2,
+        axis_tol=1e-6
+    )
+
+    feat_list = [lvl_feat, bow_poly_feat, bow_dist_feat]
+
+    # 多尺度 FFT 平滑（可选）
+    if fft_sigma_list:
+        feat_list.append(build_leveling_fft_features(
+            targets_df=targets_df,
+            leveling_df=leveling_df,
+            value_col="z",
+            sigma_list=fft_sigma_list,
+            grid_step=1000.0,
+        ))
+
+    # 合并（按 wafer_id,x,y 对齐）
+    df = targets_df.copy()
+    for feat_df in feat_list:
+        df = df.merge(feat_df, on=["wafer_id","x","y"], how="left")
+
+    # 加 global
+    if wafer_df is not None:
+        df = df.merge(wafer_df, on="wafer_id", how="left")
+
+    # 位置特征（建议保留）
+    x = df["x"].to_numpy()
+    y = df["y"].to_numpy()
+    df["r"] = np.sqrt(x*x + y*y)
+    df["theta"] = np.arctan2(y, x)
+
+    return df
+
+
+⸻
+
+4) 参数怎么选
+	•	grid_step：取 leveling 平均点距左右（µm 坐标下 1000 比较常见）。比点距小很多时，很多格子是空的，G*w 会变小，NaN 会变多；这时把 min_support 调小或 grid_step 调大。
+	•	sigma_list：最小尺度不要小于 ~2 个 grid_step，否则就是在网格上做插值；最大尺度到 wafer 半径量级就够了，再大就是全片均值。
+	•	内存：频域中间数组约 尺度数 × 8 × 网格点数 × 16 字节，超过 max_chunk_bytes（默认 256MB）会自动按尺度分批。300mm wafer、1000µm 网格时每片一次就算完。
+
+用法：
+
+df = assemble_training_table(targets_df, leveling_df, bow_df, wafer_df,
+                             fft_sigma_list=(2500.0, 5000.0, 10000.0, 20000.0, 40000.0))
+result = train_lgbm_groupkfold(df, target_col="overlay", group_col="wafer_id", drop_cols=("wafer_id",))
+
+⸻
+
+
+
+
+
+
+下面给你一个 dense map 模式：在整片 wafer 的规则网格上（几万个虚拟 target）直接出 overlay 预测栅格，用来做 disposition。
+
+直接把几万个点的 targets_df 丢进 assemble_training_table 会很慢，主要慢在三处：
+	•	build_leveling_local_features 里每个 target 一次 lstsq（kNN 平面 + 二次 + 半径平面）
+	•	build_bow_poly_features 里 iterrows 逐点算多项式
+	•	最后按 (wafer_id,x,y) 做三次 merge
+
+dense 模式的做法：
+	•	每片 wafer 只建一次 KDTree、只拟合一次 bow 多项式、只做一次 FFT（如果用了 lvl_gs*）
+	•	网格点分 chunk，每个 chunk 内所有特征都是数组运算（局部平面 / 二次拟合用批量法方程 + pinv 一次解完）
+	•	特征直接按 result["feature_cols"] 的顺序拼矩阵，折模型取平均，填回 (ny, nx) 栅格
+	•	chunk 大小由 max_chunk_bytes 估算，内存不随网格点数增长
+
+列名与原来的 builder 完全一致，数值在浮点误差范围内一致：局部拟合用的是法方程 + pinv，不是逐点 lstsq，法方程会把条件数平方，邻域很病态（点几乎共线）时斜率 / 曲率会和 lstsq 有可见差异。我用同一批点对过 assemble_training_table + 模型预测，差异远小于模型本身的误差，所以训练好的模型可以直接用。
+
+⸻
+
+1) 向量化的特征块 + 网格生成 + dense 预测
+
+依赖前面的 fit_bow_poly_per_wafer / _eval_poly_and_derivatives，以及 FFT 那一节的 _make_wafer_grid / _rasterize / _gaussian_transfer_stack / _fft_smooth_maps / _bilinear_sample。
+
+def _batched_plane_quad(dx, dy, Z, valid, with_quad=True):
+    """
+    批量局部拟合（每行一个 target 的邻域），坐标已平移到 target 点。
+    dx, dy, Z, valid: (n, k)，valid=False 的位置不参与拟合（半径邻域 padding 用）
+    用法方程 + 批量 pinv，一次算完所有 target。数学上等价于 lstsq 的最小范数解，
+    但法方程把条件数平方了，病态邻域上数值只在浮点误差内接近 lstsq。
+    返回 plane (n,3)=[a,b,c0]，quad (n,6)=[a,b,c,d,e,f]（c0/f 是 target 点处的截距）
+    """
+    wv = valid.astype(float)
+    # 每个邻域按 rms 距离缩放，避免 µm 坐标下 x^4 把法方程搞病态
+    h = np.sqrt(np.sum(wv * (dx*dx + dy*dy), axis=1) / np.maximum(wv.sum(axis=1), 1))
+    h = np.where(h > 0, h, 1.0)[:, None]
+    u = dx / h; v = dy / h
+
+    def solve(cols):
+        A = np.stack(cols, axis=-1) * wv[..., None]            # (n, k, m)
+        AtA = np.einsum("nki,nkj->nij", A, A)
+        Atz = np.einsum("nki,nk->ni", A, np.where(valid, Z, 0.0))
+        return np.einsum("nij,nj->ni", np.linalg.pinv(AtA), Atz)
+
+    one = np.ones_like(u)
+    p = solve([u, v, one])
+    plane = np.c_[p[:,0] / h[:,0], p[:,1] / h[:,0], p[:,2]]
+    quad = None
+    if with_quad:
+        q = solve([u*u, v*v, u*v, u, v, one])
+        h1 = h[:,0]; h2 = h1*h1
+        quad = np.c_[q[:,0]/h2, q[:,1]/h2, q[:,2]/h2, q[:,3]/h1, q[:,4]/h1, q[:,5]]
+    return plane, quad
+
+def _leveling_local_block(tree, L_xy, L_z, T_xy, knn_list=(32, 64), radius_list=(5000.0, 10000.0),
+                          add_quad_curvature=True, min_pts_plane=6, min_pts_quad=10):
+    """
+    build_leveling_local_features 的向量化版本（单片 wafer、一块 target）。
+    tree / L_xy / L_z 每片 wafer 建一次，dense map 的每个 chunk 复用。
+    返回 dict: 列名 -> (n,) 数组，列名与 build_leveling_local_features 完全一致。
+    """
+    n = len(T_xy)
+    out = {}
+    tx = T_xy[:, 0:1]; ty = T_xy[:, 1:2]
+
+    for k in knn_list:
+        kk = min(k, len(L_xy))
+        _, idx = tree.query(T_xy, k=kk)
+        Z = L_z[idx]
+        out[f"lvl_knn{k}_mean"] = np.nanmean(Z, axis=1)
+        out[f"lvl_knn{k}_std"] = np.nanstd(Z, axis=1)
+        out[f"lvl_knn{k}_ptp"] = np.nanmax(Z, axis=1) - np.nanmin(Z, axis=1)
+        out[f"lvl_knn{k}_median"] = np.nanmedian(Z, axis=1)
+
+        dx = L_xy[idx, 0] - tx; dy = L_xy[idx, 1] - ty
+        plane, quad = _batched_plane_quad(dx, dy, Z, np.ones_like(Z, dtype=bool), add_quad_curvature)
+        ok = kk >= min_pts_plane
+        nan = np.full(n, np.nan)
+        out[f"lvl_knn{k}_tilt_x"] = plane[:,0] if ok else nan
+        out[f"lvl_knn{k}_tilt_y"] = plane[:,1] if ok else nan
+        # 截距换回 wafer 中心原点：c = c0 - a*tx - b*ty
+        out[f"lvl_knn{k}_plane_c"] = plane[:,2] - plane[:,0]*tx[:,0] - plane[:,1]*ty[:,0] if ok else nan
+        if add_quad_curvature:
+            okq = kk >= min_pts_quad
+            out[f"lvl_knn{k}_d2x2"] = 2*quad[:,0] if okq else nan
+            out[f"lvl_knn{k}_d2y2"] = 2*quad[:,1] if okq else nan
+            out[f"lvl_knn{k}_d2xy"] = quad[:,2] if okq else nan
+            out[f"lvl_knn{k}_laplacian"] = 2*quad[:,0] + 2*quad[:,1] if okq else nan
+
+    for r in radius_list:
+        ind = tree.query_radius(T_xy, r=r)
+        cnt = np.fromiter((len(ii) for ii in ind), dtype=int, count=n)
+        flat = np.concatenate(ind) if n else np.zeros(0, dtype=int)
+        grp = np.repeat(np.arange(n), cnt)
+        z = L_z[flat]
+        has = cnt > 0
+        c = np.maximum(cnt, 1)
+
+        s1 = np.bincount(grp, weights=z, minlength=n)
+        s2 = np.bincount(grp, weights=z*z, minlength=n)
+        mean = s1 / c
+        std = np.sqrt(np.maximum(s2 / c - mean*mean, 0.0))
+
+        # 组内排序：median / ptp 都从排好序的扁平数组里按位置取
+        order = np.lexsort((z, grp))
+        zs = z[order]
+        start = np.r_[0, np.cumsum(cnt)[:-1]]
+        lo = start + (c - 1) // 2; hi = start + c // 2
+        last = start + c - 1
+        zs_pad = np.r_[zs, np.nan]                # 空邻域时索引落到 NaN
+        lo = np.where(has, lo, len(zs)); hi = np.where(has, hi, len(zs)); last = np.where(has, last, len(zs))
+        first = np.where(has, start, len(zs))
+
+        out[f"lvl_rad{r}_mean"] = np.where(has, mean, np.nan)
+        out[f"lvl_rad{r}_std"] = np.where(has, std, np.nan)
+        out[f"lvl_rad{r}_ptp"] = zs_pad[last] - zs_pad[first]
+        out[f"lvl_rad{r}_median"] = 0.5 * (zs_pad[lo] + zs_pad[hi])
+
+        # 半径邻域点数不一样：pad 成 (n, max_cnt) + valid mask 再批量拟合平面
+        m = max(int(cnt.max()) if n else 0, 1)
+        pos = np.arange(len(flat)) - np.repeat(start, cnt)
+        P = np.zeros((n, m), dtype=int); V = np.zeros((n, m), dtype=bool)
+        P[grp, pos] = flat; V[grp, pos] = True
+        dx = L_xy[P, 0] - tx; dy = L_xy[P, 1] - ty
+        plane, _ = _batched_plane_quad(dx, dy, L_z[P], V, with_quad=False)
+        okp = cnt >= min_pts_plane
+        out[f"lvl_rad{r}_tilt_x"] = np.where(okp, plane[:,0], np.nan)
+        out[f"lvl_rad{r}_tilt_y"] = np.where(okp, plane[:,1], np.nan)
+    return out
+
+def _bow_distance_block(tree, B_xy, B_z, bx, by, T_xy, value_col="z", knn_list=(3, 5), idw_power=2):
+    """
+    build_bow_distance_features 的向量化版本（单片 wafer）。
+    bx / by: 该 wafer 已筛好的 x 轴 / y 轴 bow 点（DataFrame），每片 wafer 筛一次。
+    """
+    out = {}
+    d1, i1 = tree.query(T_xy, k=1)
+    out["bow_nearest_dist"] = d1[:,0]
+    out["bow_nearest_val"] = B_z[i1[:,0]]
+    out["bow_dist_to_xaxis"] = np.abs(T_xy[:,1])
+    out["bow_dist_to_yaxis"] = np.abs(T_xy[:,0])
+
+    for k in knn_list:
+        dists, idx = tree.query(T_xy, k=min(k, len(B_xy)))
+        zz = B_z[idx]
+        w = 1.0 / np.maximum(dists, 1e-12)**idw_power
+        out[f"bow_idw_knn{k}"] = np.sum(w * zz, axis=1) / np.sum(w, axis=1)
+        out[f"bow_knn{k}_mean"] = np.mean(zz, axis=1)
+        out[f"bow_knn{k}_std"] = np.std(zz, axis=1)
+
+    def interp_1d(xq, xp, fp):
+        order = np.argsort(xp)
+        return np.interp(xq, xp[order], fp[order])
+
+    nan = np.full(len(T_xy), np.nan)
+    out["bow_xproj"] = (interp_1d(T_xy[:,0], bx["x"].to_numpy(), bx[value_col].to_numpy().astype(float))
+                        if len(bx) >= 2 else nan)
+    out["bow_yproj"] = (interp_1d(T_xy[:,1], by["y"].to_numpy(), by[value_col].to_numpy().astype(float))
+                        if len(by) >= 2 else nan)
+    with np.errstate(all="ignore"):
+        both = np.c_[out["bow_xproj"], out["bow_yproj"]]
+        cnt = np.sum(~np.isnan(both), axis=1)
+        out["bow_proj_mean"] = np.where(cnt > 0, np.nansum(both, axis=1) / np.maximum(cnt, 1), np.nan)
+    return out
+
+def make_wafer_grid_points(grid_step=2000.0, wafer_radius=150000.0, edge_exclusion=0.0):
+    """
+    生成 wafer 上的规则虚拟 target 网格（中心为原点）。
+    返回 (gx, gy, xy, flat_idx)：
+        gx (nx,), gy (ny,) —— 栅格坐标轴
+        xy (n,2)           —— wafer 内的网格点
+        flat_idx (n,)      —— 在 (ny, nx) 栅格里的扁平下标，用于把预测填回栅格
+    """
+    g = np.arange(-wafer_radius, wafer_radius + 0.5 * grid_step, grid_step)
+    X, Y = np.meshgrid(g, g)
+    inside = (X*X + Y*Y) <= (wafer_radius - edge_exclusion)**2
+    flat_idx = np.flatnonzero(inside)
+    xy = np.c_[X.ravel()[flat_idx], Y.ravel()[flat_idx]]
+    return g, g.copy(), xy, flat_idx
+
+def predict_dense_wafer_maps(
+    result,
+    leveling_df: pd.DataFrame,
+    bow_df: pd.DataFrame,
+    wafer_df: pd.DataFrame = None,
+    wafer_ids=None,
+    grid_step: float = 2000.0,
+    wafer_radius: float = 150000.0,
+    edge_exclusion: float = 0.0,
+    max_chunk_bytes: int = 256 * 2**20,
+    # 以下特征参数必须和训练时 assemble_training_table 用的一致
+    knn_list=(32, 64),
+    radius_list=(5000.0, 10000.0),
+    add_quad_curvature=True,
+    degree=2,
+    ridge_alpha=1e-6,
+    bow_knn_list=(3, 5),
+    idw_power=2,
+    axis_tol=1e-6,
+    min_pts_plane=6,
+    min_pts_quad=10,
+    fft_sigma_list=None,
+    fft_grid_step=1000.0,
+    fft_layout=None,     # (x0, y0, nx, ny)：训练时的 FFT 网格布局；None 时按 leveling + dense 网格重新算
+    fft_H=None,          # 和 fft_layout 配套的频域核（OverlayPipeline 里 mmap 的那份），None 时重新算
+    gp_length_scales=None,   # GP / 克里金 bow 特征（_bow_gp_block），None 时不算
+    gp_nugget=1e-3,
+    value_col="z",
+):
+    """
+    全片 dense overlay map：在规则网格上生成虚拟 target，分块算特征 + 折模型平均预测。
+
+    result: train_lgbm_groupkfold 的返回（用 models / feature_cols）
+    每片 wafer 只建一次 KDTree、拟合一次 bow 多项式、做一次 FFT；
+    网格点按 chunk 处理，chunk 大小由 max_chunk_bytes 估算，整体内存不随网格点数增长。
+
+    返回 dict: wafer_id -> {"x": gx, "y": gy, "pred": (ny, nx) 栅格，wafer 外为 NaN}
+    """
+    models = result["models"]
+    feature_cols = list(result["feature_cols"])
+
+    gx, gy, grid_xy, flat_idx = make_wafer_grid_points(grid_step, wafer_radius, edge_exclusion)
+    n_grid = len(grid_xy)
+
+    lvl_groups = {wid: g for wid, g in leveling_df.groupby("wafer_id")}
+    bow_groups = {wid: g for wid, g in bow_df.groupby("wafer_id")}
+    poly_models = fit_bow_poly_per_wafer(bow_df, degree=degree, ridge_alpha=ridge_alpha, value_col=value_col)
+    wafer_rows = wafer_df.set_index("wafer_id") if wafer_df is not None else None
+    if wafer_ids is None:
+        wafer_ids = sorted(set(lvl_groups) | set(bow_groups))
+
+    # chunk 大小：特征矩阵 + 最大邻域的中间数组。kNN 二次拟合 (n,k,6)；半径邻域 pad 成 (n,max_cnt)，
+    # 每个 padded 位置约 10 个 8 字节的中间量。max_cnt 用最大半径的 count_only 查询取所有 wafer 的最大值，
+    # 所有 wafer 用同一个 chunk 大小（网格 chunk 布局不变）
+    k_max = max(list(knn_list) + list(bow_knn_list) + [1])
+    max_cnt = 0
+    if radius_list:
+        r_max = max(radius_list)
+        for wid in wafer_ids:
+            ldf = lvl_groups.get(wid)
+            if ldf is not None and len(ldf):
+                cnt = KDTree(ldf[["x","y"]].to_numpy().astype(float)).query_radius(grid_xy, r=r_max, count_only=True)
+                max_cnt = max(max_cnt, int(cnt.max()))
+    bytes_per_row = 8 * (len(feature_cols) + 16 * k_max + 10 * max_cnt)
+    chunk = int(max(1000, min(n_grid, max_chunk_bytes // bytes_per_row)))
+
+    if fft_sigma_list:
+        fft_sigma_list = tuple(float(s) for s in fft_sigma_list)
+        if fft_layout is not None:
+            # 用训练时的网格，lvl_gs* 和 transform / predict 完全一致
+            x0, y0, nx, ny = fft_layout
+            nx, ny = int(nx), int(ny)
+        else:
+            x0, y0, nx, ny = _make_wafer_grid([leveling_df[["x","y"]].to_numpy(), grid_xy],
+                                              grid_step=fft_grid_step, pad=3 * max(fft_sigma_list))
+        H = fft_H if fft_H is not None and fft_layout is not None else \
+            _gaussian_transfer_stack(fft_sigma_list, nx, ny, fft_grid_step)
+
+    missing_reported = False
+    gp_cache = {}   # 克里金权重，见下面 chunk 循环
+    maps = {}
+    for wafer_id in wafer_ids:
+        # ---- 每片 wafer 一次性的准备 ----
+        ldf = lvl_groups.get(wafer_id)
+        bdf = bow_groups.get(wafer_id)
+        lvl_state = None
+        if ldf is not None and len(ldf):
+            L_xy = ldf[["x","y"]].to_numpy().astype(float)
+            lvl_state = (KDTree(L_xy), L_xy, ldf[value_col].to_numpy().astype(float))
+        bow_state = None
+        if bdf is not None and len(bdf):
+            B_xy = bdf[["x","y"]].to_numpy().astype(float)
+            bow_state = (KDTree(B_xy), B_xy, bdf[value_col].to_numpy().astype(float),
+                         bdf[np.abs(bdf["y"]) <= axis_tol], bdf[np.abs(bdf["x"]) <= axis_tol])
+        poly_coef = None
+        if wafer_id in poly_models:
+            poly, model = poly_models[wafer_id]
+            poly_coef = (poly, model.coef_, [f"bow_polycoef_{n}" for n in poly.get_feature_names_out(["x","y"])])
+        fft_maps = None
+        if fft_sigma_list and lvl_state is not None:
+            zw, w = _rasterize(lvl_state[1], lvl_state[2], x0, y0, nx, ny, fft_grid_step)
+            fft_maps, support = _fft_smooth_maps(zw, w, H)
+            fft_maps = np.where(support[:, None] >= 1e-3, fft_maps, np.nan)
+        const = {}
+        if wafer_rows is not None and wafer_id in wafer_rows.index:
+            const = wafer_rows.loc[wafer_id].to_dict()
+
+        pred = np.full(len(gy) * len(gx), np.nan)
+        for s in range(0, n_grid, chunk):
+            T_xy = grid_xy[s:s+chunk]
+            cols = {"x": T_xy[:,0], "y": T_xy[:,1]}
+            if lvl_state is not None:
+                cols.update(_leveling_local_block(lvl_state[0], lvl_state[1], lvl_state[2], T_xy,
+                                                  knn_list, radius_list, add_quad_curvature,
+                                                  min_pts_plane, min_pts_quad))
+            if poly_coef is not None:
+                poly, coef, coef_cols = poly_coef
+                f, dfdx, dfdy, d2x2, d2y2, d2xy, lap = _eval_poly_and_derivatives(poly, coef, T_xy)
+                cols.update({"bow_poly_hat": f, "bow_poly_dBdx": dfdx, "bow_poly_dBdy": dfdy,
+                             "bow_poly_d2x2": d2x2, "bow_poly_d2y2": d2y2, "bow_poly_d2xy": d2xy,
+                             "bow_poly_laplacian": lap})
+                cols.update({c: np.full(len(T_xy), v) for c, v in zip(coef_cols, coef)})
+            if bow_state is not None:
+                cols.update(_bow_distance_block(bow_state[0], bow_state[1], bow_state[2],
+                                                bow_state[3], bow_state[4], T_xy,
+                                                value_col, bow_knn_list, idw_power))
+                if gp_length_scales:
+                    # 权重按 (bow 布局, chunk 布局, ℓ) 缓存在本次调用的 gp_cache 里：每片 wafer 的 chunk 布局相同，
+                    # bow 布局相同时每个 chunk × ℓ 只在第一片上算。不用全局 LRU（只有 _GP_CACHE_MAX 项，
+                    # chunk 多时会被挤掉、每片重算）
+                    cols.update(_bow_gp_block(bow_state[1], bow_state[2], T_xy, gp_length_scales, gp_nugget,
+                                              cache=gp_cache))
+            if fft_maps is not None:
+                vals = _bilinear_sample(fft_maps, T_xy, x0, y0, fft_grid_step)
+                names = ["mean", "tilt_x", "tilt_y", "laplacian"]
+                cols.update({f"lvl_gs{sg}_{nm}": vals[i, j]
+                             for i, sg in enumerate(fft_sigma_list) for j, nm in enumerate(names)})
+            cols.update({c: np.full(len(T_xy), v) for c, v in const.items()})
+            cols["r"] = np.sqrt(T_xy[:,0]**2 + T_xy[:,1]**2)
+            cols["theta"] = np.arctan2(T_xy[:,1], T_xy[:,0])
+
+            missing = [c for c in feature_cols if c not in cols]
+            if missing and not missing_reported:
+                print(f"[dense map] 以下特征在 dense 模式下没有生成，按 NaN 处理：{missing}")
+                missing_reported = True
+            X = pd.DataFrame({c: cols.get(c, np.nan) for c in feature_cols})
+            X = X.replace([np.inf, -np.inf], np.nan)
+
+            p = np.zeros(len(T_xy))
+            for m in models:
+                p += m.predict(X, num_iteration=m.best_iteration)
+            pred[flat_idx[s:s+chunk]] = p / len(models)
+
+        maps[wafer_id] = {"x": gx, "y": gy, "pred": pred.reshape(len(gy), len(gx))}
+    return maps
+
+
+⸻
+
+2) 用法
+
+result = train_lgbm_groupkfold(df, target_col="overlay", group_col="wafer_id", drop_cols=("wafer_id",))
+
+maps = predict_dense_wafer_maps(
+    result, leveling_df, bow_df, wafer_df,
+    grid_step=2000.0,          # 300mm wafer 约 1.77 万个点
+    wafer_radius=150000.0,
+    edge_exclusion=3000.0,
+    max_chunk_bytes=256 * 2**20,
+)
+
+m = maps[wafer_id]
+plt.imshow(m["pred"], origin="lower", extent=[m["x"][0], m["x"][-1], m["y"][0], m["y"][-1]])
+
+⸻
+
+3) 注意事项
+	•	特征参数（knn_list / radius_list / degree / axis_tol / fft_sigma_list …）必须和训练时一致，dense 模式不会替你检查。
+	•	如果训练表里有 targets_df 自带的列（比如 field_id、die 坐标），dense 网格上没有，会打印一次提示并按 NaN 喂给模型；这种列最好训练时就放进 drop_cols。
+	•	lvl_gs* 的 FFT 网格：传了 fft_layout / fft_H（OverlayPipeline.predict_dense 会自动传）就用训练时的网格，和 transform 完全一致；不传时按 leveling + dense 网格重新算，和训练时的网格可能差半个格点，双线性采样值会有极小差异。训练时网格没覆盖到的位置 lvl_gs* 为 NaN。
+	•	wafer 外的格点是 NaN，画图 / 统计时用 np.nanmax 之类。
+
+⸻
+
+
+
+
+
+
+下面把 ovl 这一套包成一个有状态的 pipeline 对象。现在的问题是函数都是无状态的，推理时 knn_list / radius_list / degree / axis_tol / min_pts_* 和 feature_cols 的顺序都得手动再传一遍，传错一个模型就悄悄出错。
+
+OverlayPipeline 做这几件事：
+	•	__init__：所有特征参数和训练参数一次写清楚
+	•	fit：建特征（向量化 block，数值与 assemble_training_table 一致）→ train_lgbm_groupkfold → 记录 feature_cols 顺序、FFT 网格布局和频域核
+	•	transform / predict：按记录好的参数和列顺序出特征 / 折模型平均
+	•	predict_dense：直接调上一节的 predict_dense_wafer_maps，参数自动对齐
+	•	save / load：一个 artifact 目录，meta.json + LightGBM 模型文本 + 可 mmap 的 .npy
+
+⸻
+
+1) 代码
+
+依赖前面几节的 builder、向量化 block（_leveling_local_block / _bow_distance_block）、FFT 工具函数和 train_lgbm_groupkfold。
+
+import json
+import os
+from pathlib import Path
+
+class OverlayPipeline:
+    """
+    把 ovl 的特征构建 + GroupKFold LightGBM 包成一个有状态的对象：
+        fit       —— 记录全部特征参数、feature_cols 顺序、FFT 网格布局，训练折模型
+        transform —— 按记录好的参数和顺序出特征矩阵（向量化 block，不走 merge）
+        predict   —— 折模型平均
+        save/load —— 一个 artifact 目录：meta.json + 模型文本 + 可 mmap 的 .npy
+    """
+
+    ARTIFACT_VERSION = 1
+
+    def __init__(
+        self,
+        knn_list=(32, 64),
+        radius_list=(5000.0, 10000.0),
+        add_quad_curvature=True,
+        min_pts_plane=6,
+        min_pts_quad=10,
+        degree=2,
+        ridge_alpha=1e-6,
+        bow_knn_list=(3, 5),
+        idw_power=2,
+        axis_tol=1e-6,
+        fft_sigma_list=None,
+        fft_grid_step=1000.0,
+        gp_length_scales=None,
+        gp_nugget=1e-3,
+        value_col="z",
+        target_col="overlay",
+        group_col="wafer_id",
+        drop_cols=("wafer_id",),
+        n_splits=5,
+        random_state=42,
+    ):
+        self.params = dict(
+            knn_list=list(knn_list),
+            radius_list=[float(r) for r in radius_list],
+            add_quad_curvature=bool(add_quad_curvature),
+            min_pts_plane=int(min_pts_plane),
+            min_pts_quad=int(min_pts_quad),
+            degree=int(degree),
+            ridge_alpha=float(ridge_alpha),
+            bow_knn_list=list(bow_knn_list),
+            idw_power=idw_power,
+            axis_tol=float(axis_tol),
+            fft_sigma_list=[float(s) for s in fft_sigma_list] if fft_sigma_list else None,
+            fft_grid_step=float(fft_grid_step),
+            gp_length_scales=[float(s) for s in gp_length_scales] if gp_length_scales else None,
+            gp_nugget=float(gp_nugget),
+            value_col=value_col,
+            target_col=target_col,
+            group_col=group_col,
+            drop_cols=list(drop_cols),
+            n_splits=int(n_splits),
+            random_state=int(random_state),
+        )
+        self.feature_cols = None
+        self.models = []
+        self.fft_layout = None    # (x0, y0, nx, ny)
+        self._fft_H = None        # 频域核 (S, 4, ny, nxr)，可 mmap
+        self.train_summary = {}
+
+    # ---------- 特征 ----------
+    def _ensure_fft_layout(self, leveling_df, targets_df):
+        sig = self.params["fft_sigma_list"]
+        if not sig or self.fft_layout is not None:
+            return
+        step = self.params["fft_grid_step"]
+        self.fft_layout = _make_wafer_grid(
+            [leveling_df[["x","y"]].to_numpy(), targets_df[["x","y"]].to_numpy()],
+            grid_step=step, pad=3 * max(sig),
+        )
+        x0, y0, nx, ny = self.fft_layout
+        self._fft_H = _gaussian_transfer_stack(sig, nx, ny, step)
+
+    def build_features(self, targets_df, leveling_df, bow_df, wafer_df=None):
+        """
+        和 assemble_training_table 同样的列（数值一致），但按 targets_df 行序直接拼，
+        不做 (wafer_id,x,y) merge。targets_df 的其他列原样保留。
+        """
+        p = self.params
+        vc = p["value_col"]
+        self._ensure_fft_layout(leveling_df, targets_df)
+
+        lvl_groups = {wid: g for wid, g in leveling_df.groupby("wafer_id")}
+        bow_groups = {wid: g for wid, g in bow_df.groupby("wafer_id")}
+        poly_models = fit_bow_poly_per_wafer(bow_df, degree=p["degree"], ridge_alpha=p["ridge_alpha"], value_col=vc)
+
+        blocks = []
+        for wafer_id, tdf in targets_df.groupby("wafer_id", sort=False):
+            T_xy = tdf[["x","y"]].to_numpy().astype(float)
+            cols = {}
+            ldf = lvl_groups.get(wafer_id)
+            if ldf is not None and len(ldf):
+                L_xy = ldf[["x","y"]].to_numpy().astype(float)
+                L_z = ldf[vc].to_numpy().astype(float)
+                cols.update(_leveling_local_block(
+                    KDTree(L_xy), L_xy, L_z, T_xy, p["knn_list"], p["radius_list"],
+                    p["add_quad_curvature"], p["min_pts_plane"], p["min_pts_quad"]))
+                if p["fft_sigma_list"]:
+                    x0, y0, nx, ny = self.fft_layout
+                    zw, w = _rasterize(L_xy, L_z, x0, y0, nx, ny, p["fft_grid_step"])
+                    maps, support = _fft_smooth_maps(zw, w, self._fft_H)
+                    maps = np.where(support[:, None] >= 1e-3, maps, np.nan)
+                    vals = _bilinear_sample(maps, T_xy, x0, y0, p["fft_grid_step"])
+                    names = ["mean", "tilt_x", "tilt_y", "laplacian"]
+                    cols.update({f"lvl_gs{s}_{n}": vals[i, j]
+                                 for i, s in enumerate(p["fft_sigma_list"]) for j, n in enumerate(names)})
+            if wafer_id in poly_models:
+                poly, model = poly_models[wafer_id]
+                f, dfdx, dfdy, d2x2, d2y2, d2xy, lap = _eval_poly_and_derivatives(poly, model.coef_, T_xy)
+                cols.update({"bow_poly_hat": f, "bow_poly_dBdx": dfdx, "bow_poly_dBdy": dfdy,
+                             "bow_poly_d2x2": d2x2, "bow_poly_d2y2": d2y2, "bow_poly_d2xy": d2xy,
+                             "bow_poly_laplacian": lap})
+                for n, c in zip(poly.get_feature_names_out(["x","y"]), model.coef_):
+                    cols[f"bow_polycoef_{n}"] = np.full(len(T_xy), c)
+            bdf = bow_groups.get(wafer_id)
+            if bdf is not None and len(bdf):
+                B_xy = bdf[["x","y"]].to_numpy().astype(float)
+                B_z = bdf[vc].to_numpy().astype(float)
+                cols.update(_bow_distance_block(
+                    KDTree(B_xy), B_xy, B_z,
+                    bdf[np.abs(bdf["y"]) <= p["axis_tol"]], bdf[np.abs(bdf["x"]) <= p["axis_tol"]],
+                    T_xy, vc, p["bow_knn_list"], p["idw_power"]))
+                # 老 artifact 的 params 里没有 gp_*，用 get
+                if p.get("gp_length_scales"):
+                    cols.update(_bow_gp_block(B_xy, B_z, T_xy, p["gp_length_scales"], p.get("gp_nugget", 1e-3)))
+            blocks.append(pd.DataFrame(cols, index=tdf.index))
+
+        df = pd.concat([targets_df, pd.concat(blocks).reindex(targets_df.index)], axis=1)
+        if wafer_df is not None:
+            df = df.join(wafer_df.set_index("wafer_id"), on="wafer_id")
+        x = df["x"].to_numpy(); y = df["y"].to_numpy()
+        df["r"] = np.sqrt(x*x + y*y)
+        df["theta"] = np.arctan2(y, x)
+        return df
+
+    def transform(self, targets_df, leveling_df, bow_df, wafer_df=None):
+        """返回按 fit 时 feature_cols 顺序排好的特征矩阵（缺的列为 NaN）"""
+        if self.feature_cols is None:
+            raise RuntimeError("pipeline 还没有 fit / load")
+        df = self.build_features(targets_df, leveling_df, bow_df, wafer_df)
+        return df.reindex(columns=self.feature_cols).replace([np.inf, -np.inf], np.nan)
+
+    # ---------- 训练 / 预测 ----------
+    def fit(self, targets_df, leveling_df, bow_df, wafer_df=None):
+        p = self.params
+        self.fft_layout = None
+        df = self.build_features(targets_df, leveling_df, bow_df, wafer_df)
+        result = train_lgbm_groupkfold(
+            df, target_col=p["target_col"], group_col=p["group_col"],
+            drop_cols=tuple(p["drop_cols"]), n_splits=p["n_splits"], random_state=p["random_state"],
+        )
+        self.models = result["models"]
+        self.feature_cols = list(result["feature_cols"])
+        self.train_summary = {k: float(v) for k, v in result["overall"].items()}
+        return result
+
+    def predict(self, targets_df, leveling_df, bow_df, wafer_df=None):
+        X = self.transform(targets_df, leveling_df, bow_df, wafer_df)
+        pred = np.zeros(len(X))
+        for m in self.models:
+            pred += m.predict(X, num_iteration=m.best_iteration)
+        return pred / len(self.models)
+
+    def predict_dense(self, leveling_df, bow_df, wafer_df=None, **kwargs):
+        """全片 dense map，特征参数、FFT 网格布局和频域核都用 fit 时记录的那一套"""
+        p = self.params
+        return predict_dense_wafer_maps(
+            {"models": self.models, "feature_cols": self.feature_cols},
+            leveling_df, bow_df, wafer_df,
+            knn_list=p["knn_list"], radius_list=p["radius_list"],
+            add_quad_curvature=p["add_quad_curvature"], degree=p["degree"],
+            ridge_alpha=p["ridge_alpha"], bow_knn_list=p["bow_knn_list"],
+            idw_power=p["idw_power"], axis_tol=p["axis_tol"],
+            min_pts_plane=p["min_pts_plane"], min_pts_quad=p["min_pts_quad"],
+            fft_sigma_list=p["fft_sigma_list"], fft_grid_step=p["fft_grid_step"],
+            fft_layout=self.fft_layout, fft_H=self._fft_H,
+            gp_length_scales=p.get("gp_length_scales"), gp_nugget=p.get("gp_nugget", 1e-3),
+            value_col=p["value_col"], **kwargs,
+        )
+
+    # ---------- 序列化 ----------
+    def save(self, artifact_dir):
+        """
+        artifact_dir/
+            meta.json          参数、feature_cols、FFT 网格布局、训练指标
+            model_fold{i}.txt  LightGBM 模型（只保留到 best_iteration）
+            fft_H.npy          FFT 频域核（可 mmap）
+        """
+        d = Path(artifact_dir)
+        d.mkdir(parents=True, exist_ok=True)
+        model_files = []
+        for i, m in enumerate(self.models, start=1):
+            name = f"model_fold{i}.txt"
+            m.save_model(str(d / name), num_iteration=m.best_iteration)
+            model_files.append(name)
+        if self._fft_H is not None:
+            np.save(d / "fft_H.npy", np.asarray(self._fft_H))
+        meta = {
+            "version": self.ARTIFACT_VERSION,
+            "params": self.params,
+            "feature_cols": self.feature_cols,
+            "fft_layout": [float(v) for v in self.fft_layout] if self.fft_layout else None,
+            "model_files": model_files,
+            "train_summary": self.train_summary,
+        }
+        # 先写临时文件再替换，避免读到写了一半的 meta
+        tmp = d / "meta.json.tmp"
+        tmp.write_text(json.dumps(meta, indent=2, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, d / "meta.json")
+        return d
+
+    @classmethod
+    def load(cls, artifact_dir, mmap=True):
+        d = Path(artifact_dir)
+        meta = json.loads((d / "meta.json").read_text(encoding="utf-8"))
+        if meta.get("version") != cls.ARTIFACT_VERSION:
+            raise ValueError(f"artifact 版本不匹配：{meta.get('version')} != {cls.ARTIFACT_VERSION}")
+        p = dict(meta["params"])
+        obj = cls.__new__(cls)
+        obj.params = p
+        obj.feature_cols = meta["feature_cols"]
+        obj.train_summary = meta.get("train_summary", {})
+        obj.models = [lgb.Booster(model_file=str(d / f)) for f in meta["model_files"]]
+        obj.fft_layout = None
+        obj._fft_H = None
+        if meta["fft_layout"] is not None:
+            x0, y0, nx, ny = meta["fft_layout"]
+            obj.fft_layout = (x0, y0, int(nx), int(ny))
+            obj._fft_H = np.load(d / "fft_H.npy", mmap_mode="r" if mmap else None)
+        return obj
+
+
+⸻
+
+2) 用法
+
+# 训练
+pipe = OverlayPipeline(knn_list=(32, 64), radius_list=(5000.0, 10000.0), degree=2,
+                       fft_sigma_list=(5000.0, 20000.0), target_col="overlay")
+result = pipe.fit(targets_df, leveling_df, bow_df, wafer_df)
+pipe.save("artifacts/ovl_v1")
+
+# 推理（另一个进程）
+pipe = OverlayPipeline.load("artifacts/ovl_v1")
+pred = pipe.predict(new_targets_df, leveling_df, bow_df, wafer_df)
+maps = pipe.predict_dense(leveling_df, bow_df, wafer_df, grid_step=2000.0)
+
+⸻
+
+3) 说明
+	•	load 只读 meta.json、解析模型文本、mmap 打开 fft_H.npy，不做任何特征计算；我这边 4 折模型 + FFT 核加载在几十毫秒量级。
+	•	模型按 best_iteration 截断保存，文件更小，predict 时 best_iteration 也自动对齐。
+	•	transform 和 predict_dense 用的都是 fit 时记下的 FFT 网格布局（predict_dense 直接用 mmap 的 fft_H，不重算频域核），min_pts_plane / min_pts_quad 也一起传过去，dense map 和 predict 在同一位置的特征一致；fit 时没覆盖到的位置 lvl_gs* 为 NaN。
+	•	meta.json 里带 version，以后改了特征定义就把 ARTIFACT_VERSION 加 1，旧 artifact 会在 load 时直接报错，而不是悄悄出错。
+	•	wafer_df（cmp_lifetime 之类）不进 artifact，推理时照常传。
+
+⸻
+
+
+
+
+
+
+下面加一个 GP / 克里金插值的 bow 特征族。现在的 bow 特征只有低阶多项式（fit_bow_poly_per_wafer）和 kNN IDW，30 点十字布局上两者都插得不好：多项式太硬，IDW 在两条轴之间基本就是最近点。
+
+关键点：bow 的 30 点布局是固定的，GP 里真正贵的部分（核矩阵 Cholesky 分解、target 的交叉协方差、梯度核）只和布局有关，和 z 无关。所以：
+	•	每个（bow 布局, target 布局, ℓ）只算一次，缓存成权重矩阵 W_hat / W_dx / W_dy
+	•	每片 wafer 的预测和梯度 = 权重矩阵 @ z，一次矩阵-向量乘
+	•	用普通克里金（均值未知、GLS 估计），均值也是 z 的线性函数，一起折进权重矩阵里
+
+⸻
+
+1) 代码
+
+from collections import OrderedDict
+
+_GP_LAYOUT_CACHE = OrderedDict()   # (bow 布局, target 布局, ℓ, nugget) -> 权重矩阵
+_GP_CACHE_MAX = 64
+
+def _layout_key(xy, decimals=3):
+    xy = np.round(np.asarray(xy, dtype=float), decimals)
+    return hash((xy.shape, xy.tobytes()))
+
+def _rbf(A, B, ell):
+    d2 = (A[:, None, 0] - B[None, :, 0])**2 + (A[:, None, 1] - B[None, :, 1])**2
+    return np.exp(-0.5 * d2 / (ell * ell))
+
+def _gp_layout_weights(B_xy, T_xy, ell, nugget=1e-3):
+    """
+    普通克里金（ordinary kriging，常数均值未知）+ RBF 核，只和布局有关的部分：
+        pred  = W_hat @ z
+        dB/dx = W_dx  @ z,  dB/dy = W_dy @ z
+        std   = 相对克里金标准差（σf=1 时，和 z 无关）
+    K 的 Cholesky 分解和 target 的交叉协方差只算一次，之后每片 wafer 都是矩阵-向量乘。
+    """
+    nb = len(B_xy)
+    K = _rbf(B_xy, B_xy, ell) + nugget * np.eye(nb)
+    Lc = np.linalg.cholesky(K)
+    Kinv = np.linalg.solve(Lc.T, np.linalg.solve(Lc, np.eye(nb)))
+    one = np.ones(nb)
+    Kinv1 = Kinv @ one
+    s = one @ Kinv1
+    a = Kinv1 / s                                    # GLS 均值权重：μ = a @ z
+
+    Ks = _rbf(T_xy, B_xy, ell)                       # (nT, nb)
+    dKx = -(T_xy[:, None, 0] - B_xy[None, :, 0]) / (ell * ell) * Ks
+    dKy = -(T_xy[:, None, 1] - B_xy[None, :, 1]) / (ell * ell) * Ks
+
+    P = np.eye(nb) - np.outer(one, a)                # z - μ·1 = P @ z
+    KsKinv = Ks @ Kinv
+    W_hat = KsKinv @ P + np.outer(np.ones(len(T_xy)), a)
+    W_dx = dKx @ Kinv @ P
+    W_dy = dKy @ Kinv @ P
+
+    var = 1.0 - np.sum(KsKinv * Ks, axis=1) + (1.0 - KsKinv @ one)**2 / s
+    std = np.sqrt(np.maximum(var, 0.0))
+    return W_hat, W_dx, W_dy, std
+
+def _cached_gp_weights(B_xy, T_xy, ell, nugget, cache=None):
+    """cache=None 用全局 LRU；传一个 dict 时用它（不淘汰，由调用方控制生命周期）"""
+    key = (_layout_key(B_xy), _layout_key(T_xy), float(ell), float(nugget))
+    if cache is not None:
+        if key not in cache:
+            cache[key] = _gp_layout_weights(B_xy, T_xy, ell, nugget)
+        return cache[key]
+    hit = _GP_LAYOUT_CACHE.get(key)
+    if hit is not None:
+        _GP_LAYOUT_CACHE.move_to_end(key)
+        return hit
+    w = _gp_layout_weights(B_xy, T_xy, ell, nugget)
+    _GP_LAYOUT_CACHE[key] = w
+    if len(_GP_LAYOUT_CACHE) > _GP_CACHE_MAX:
+        _GP_LAYOUT_CACHE.popitem(last=False)
+    return w
+
+def _bow_gp_block(B_xy, B_z, T_xy, length_scales=(30000.0, 60000.0), nugget=1e-3, cache=None):
+    """单片 wafer 的 GP bow 特征，返回 dict: 列名 -> (nT,) 数组；cache 见 _cached_gp_weights"""
+    ok = np.isfinite(B_z)
+    B_xy = B_xy[ok]; B_z = B_z[ok]
+    out = {}
+    for ell in length_scales:
+        ell = float(ell)
+        if len(B_z) < 3:
+            for n in ("hat", "dBdx", "dBdy", "std"):
+                out[f"bow_gp{ell}_{n}"] = np.full(len(T_xy), np.nan)
+            continue
+        W_hat, W_dx, W_dy, std = _cached_gp_weights(B_xy, T_xy, ell, nugget, cache)
+        out[f"bow_gp{ell}_hat"] = W_hat @ B_z
+        out[f"bow_gp{ell}_dBdx"] = W_dx @ B_z
+        out[f"bow_gp{ell}_dBdy"] = W_dy @ B_z
+        out[f"bow_gp{ell}_std"] = std
+    return out
+
+def build_bow_gp_features(
+    targets_df: pd.DataFrame,
+    bow_df: pd.DataFrame,
+    value_col="z",
+    length_scales=(30000.0, 60000.0),   # 单位同坐标；十字 30 点的点距量级起步
+    nugget=1e-3,                        # 相对噪声（σn²/σf²），越大越平滑
+):
+    """
+    GP / 克里金插值 bow 特征：bow_gp{ℓ}_hat / _dBdx / _dBdy / _std
+    bow 布局固定时，所有 wafer 共用同一份分解和交叉协方差（见 _GP_LAYOUT_CACHE）。
+    """
+    bow_groups = {wid: g for wid, g in bow_df.groupby("wafer_id")}
+    out_rows = []
+    for wafer_id, tdf in targets_df.groupby("wafer_id"):
+        feat = tdf[["wafer_id","x","y"]].copy()
+        bdf = bow_groups.get(wafer_id)
+        if bdf is None or len(bdf) == 0:
+            out_rows.append(feat)
+            continue
+        cols = _bow_gp_block(bdf[["x","y"]].to_numpy().astype(float),
+                             bdf[value_col].to_numpy().astype(float),
+                             tdf[["x","y"]].to_numpy().astype(float),
+                             length_scales, nugget)
+        out_rows.append(pd.concat([feat, pd.DataFrame(cols, index=feat.index)], axis=1))
+    return pd.concat(out_rows, ignore_index=True)
+
+
+⸻
+
+2) 输出列（每个长度尺度 ℓ 一组）
+	•	bow_gp{ℓ}_hat：GP 插值的 bow
+	•	bow_gp{ℓ}_dBdx / bow_gp{ℓ}_dBdy：解析梯度（RBF 核直接求导，不是差分）
+	•	bow_gp{ℓ}_std：相对克里金标准差，只和位置有关，表示这个 target 离 bow 点有多“远”，离十字越远越大，树模型可以用它来决定信不信 bow_gp 的值
+
+⸻
+
+3) 接进训练表 / pipeline / dense map
+
+三个入口都加同样的两个参数 gp_length_scales=None、gp_nugget=1e-3，默认 None 不算，和原来完全一样。
+
+assemble_training_table 换成下面这版（在 FFT 那一版的基础上加 GP 一段）：
+
+def assemble_training_table(targets_df, leveling_df, bow_df, wafer_df=None, fft_sigma_list=None,
+                            gp_length_scales=None, gp_nugget=1e-3):
+    lvl_feat = build_leveling_local_features(
+        targets_df=targets_df,
+        leveling_df=leveling_df,
+        value_col="z",
+        knn_list=(32,64),
+        radius_list=(5000.0,10000.0),
+        add_quad_curvature=True
+    )
+
+    bow_poly_feat = build_bow_poly_features(
+        targets_df=targets_df,
+        bow_df=bow_df,
+        degree=2,
+        ridge_alpha=1e-6,
+        value_col="z",
+        add_wafer_level_coefs=True
+    )
+
+    bow_dist_feat = build_bow_distance_features(
+        targets_df=targets_df,
+        bow_df=bow_df,
+        value_col="z",
+        knn_list=(3,5),
+        idw_power=2,
+        axis_tol=1e-6
+    )
+
+    feat_list = [lvl_feat, bow_poly_feat, bow_dist_feat]
+
+    # 多尺度 FFT 平滑（可选）
+    if fft_sigma_list:
+        feat_list.append(build_leveling_fft_features(
+            targets_df=targets_df,
+            leveling_df=leveling_df,
+            value_col="z",
+            sigma_list=fft_sigma_list,
+            grid_step=1000.0,
+        ))
+
+    # GP / 克里金 bow（可选）
+    if gp_length_scales:
+        feat_list.append(build_bow_gp_features(
+            targets_df=targets_df,
+            bow_df=bow_df,
+            value_col="z",
+            length_scales=gp_length_scales,
+            nugget=gp_nugget,
+        ))
+
+    # 合并（按 wafer_id,x,y 对齐）
+    df = targets_df.copy()
+    for feat_df in feat_list:
+        df = df.merge(feat_df, on=["wafer_id","x","y"], how="left")
+
+    # 加 global
+    if wafer_df is not None:
+        df = df.merge(wafer_df, on="wafer_id", how="left")
+
+    # 位置特征（建议保留）
+    x = df["x"].to_numpy()
+    y = df["y"].to_numpy()
+    df["r"] = np.sqrt(x*x + y*y)
+    df["theta"] = np.arctan2(y, x)
+
+    return df
+
+OverlayPipeline 和 predict_dense_wafer_maps 已经在上面两节的代码里加好了：
+	•	OverlayPipeline(gp_length_scales=..., gp_nugget=...)：参数存进 self.params / meta.json，build_features 在 bow 距离特征后面调 _bow_gp_block；predict_dense 自动把这两个参数传下去。老 artifact 的 params 里没有 gp_*，load 后照常用（不算 GP 特征）。
+	•	predict_dense_wafer_maps(..., gp_length_scales=..., gp_nugget=...)：每个 chunk 调一次 _bow_gp_block，权重存在本次调用自己的缓存里（不走全局 LRU，不会因为 chunk 多被挤掉）。每片 wafer 的网格 chunk 布局一样，bow 布局也一样时，每个 chunk × ℓ 只在第一片上算一次；缓存大小约为 网格点数 × bow 点数 × 3 × 8 字节 × len(ℓ)，2 mm 网格、30 个 bow 点、两个 ℓ 大约 25 MB。
+
+用法：
+
+df = assemble_training_table(targets_df, leveling_df, bow_df, wafer_df, gp_length_scales=(30000.0, 60000.0))
+
+pipe = OverlayPipeline(gp_length_scales=(30000.0, 60000.0), gp_nugget=1e-3)
+pipe.fit(targets_df, leveling_df, bow_df, wafer_df)
+maps = pipe.predict_dense(leveling_df, bow_df, wafer_df, grid_step=2000.0)
+
+⸻
+
+4) 参数建议
+	•	length_scales：从十字上相邻 bow 点间距的 1~3 倍起步（15 点 / 轴、300mm 时点距 ~2 万 µm，就试 30000 / 60000）。太小会在两条轴之间回落到均值，太大就退化成低阶曲面。
+	•	nugget：相对噪声。bow 量测噪声大就调大（1e-2），数据很干净可以 1e-4；太小时 K 可能不正定，Cholesky 会报错。
+	•	缓存按布局坐标（保留 3 位小数）做 key，target 布局每片都一样时命中率 100%；每片 target 不同也没关系，只是每片多算一次 30×30 的分解，成本依然很低。缓存最多 64 个布局，LRU 淘汰。
+
+⸻
+
+
+
+
+
+
+下面给你一个可插拔的 bow 基函数库：Cartesian 多项式、Zernike、径向 Chebyshev 三种，值 / 导数矩阵按布局预计算并缓存，拟合和评估对所有 wafer 都变成矩阵乘。
+
+现在的 build_bow_poly_features 有两个问题：
+	•	只支持 PolynomialFeatures 这一种基，做 wafer shape 的同事习惯用 Zernike / 径向基
+	•	_eval_poly_and_derivatives 逐项累加，外面还套一层 iterrows，每个 target 调一次
+
+思路：三种基其实都是 (u,v)=(x/R, y/R) 的多项式，所以统一成「基系数矩阵 C × 单项式矩阵」：
+	•	Zernike：ρ^(n-2k)·cos(mθ) = (u²+v²)^(...)·Re((u+iv)^m)，展开成单项式，原点处没有极坐标奇异，导数是精确的
+	•	径向 Chebyshev：T_k(2ρ²−1)，也是 (u,v) 的多项式，再加 u、v 两个 tilt 项
+	•	Cartesian：单项式本身，顺序和 sklearn PolynomialFeatures 一致
+
+对每个布局缓存两样东西：
+	•	评估矩阵 (6, n, n_basis)：值、∂x、∂y、∂xx、∂yy、∂xy
+	•	拟合投影矩阵 P = (ΦᵀΦ + αD)⁻¹Φᵀ：同一 bow 布局的所有 wafer，系数 = P @ Z 一次算完
+
+⸻
+
+1) 代码
+
+需要上一节的 _layout_key 和 OrderedDict。
+
+from itertools import combinations_with_replacement
+from math import factorial
+
+# ---------- (u,v) 多项式的小工具：dict {(a,b): coef} 表示 Σ coef·u^a·v^b ----------
+def _pmul(p, q):
+    out = {}
+    for (a1, b1), c1 in p.items():
+        for (a2, b2), c2 in q.items():
+            k = (a1 + a2, b1 + b2)
+            out[k] = out.get(k, 0.0) + c1 * c2
+    return out
+
+def _padd(*ps, scale=None):
+    out = {}
+    for i, p in enumerate(ps):
+        s = 1.0 if scale is None else scale[i]
+        for k, c in p.items():
+            out[k] = out.get(k, 0.0) + s * c
+    return out
+
+def _ppow(p, n):
+    out = {(0, 0): 1.0}
+    for _ in range(n):
+        out = _pmul(out, p)
+    return out
+
+_U = {(1, 0): 1.0}
+_V = {(0, 1): 1.0}
+_RHO2 = {(2, 0): 1.0, (0, 2): 1.0}
+
+def _monomial_exponents(max_deg):
+    """和 sklearn PolynomialFeatures(include_bias=True) 相同的顺序：1, x, y, x^2, x y, y^2, ..."""
+    exps = []
+    for d in range(max_deg + 1):
+        for combo in combinations_with_replacement((0, 1), d):
+            exps.append((combo.count(0), combo.count(1)))
+    return exps
+
+def _monomial_name(a, b):
+    parts = []
+    if a: parts.append("x" if a == 1 else f"x^{a}")
+    if b: parts.append("y" if b == 1 else f"y^{b}")
+    return " ".join(parts) if parts else "1"
+
+# ---------- 基函数库：每个基 = 名字列表 + 在 (u,v)=(x/R, y/R) 单项式上的系数 ----------
+def _basis_poly(degree):
+    exps = _monomial_exponents(degree)
+    names = [_monomial_name(a, b) for a, b in exps]
+    return names, [{e: 1.0} for e in exps]
+
+def _zernike_radial_poly(n, m):
+    """R_n^m(ρ) 的系数：Σ_k c_k ρ^(n-2k)"""
+    return [((-1)**k * factorial(n - k) / (factorial(k) * factorial((n + m)//2 - k) * factorial((n - m)//2 - k)), n - 2*k)
+            for k in range((n - m)//2 + 1)]
+
+def _basis_zernike(degree):
+    """
+    Zernike（OSA/ANSI 顺序，径向阶 n ≤ degree），单位圆上正交。
+    ρ^(n-2k)·cos(mθ) = (u²+v²)^((n-2k-m)/2) · Re((u+iv)^m)，展开成 (u,v) 多项式。
+    """
+    names, polys = [], []
+    for n in range(degree + 1):
+        for m in range(-n, n + 1, 2):
+            am = abs(m)
+            # Re / Im((u+iv)^|m|)
+            re, im = {}, {}
+            for j in range(am + 1):
+                c = factorial(am) / (factorial(j) * factorial(am - j))
+                term = {(am - j, j): c}
+                if j % 4 == 0:   re = _padd(re, term)
+                elif j % 4 == 1: im = _padd(im, term)
+                elif j % 4 == 2: re = _padd(re, term, scale=[1.0, -1.0])
+                else:            im = _padd(im, term, scale=[1.0, -1.0])
+            ang = re if m >= 0 else im
+            if am == 0:
+                ang = {(0, 0): 1.0}
+            p = {}
+            for c, pw in _zernike_radial_poly(n, am):
+                p = _padd(p, _pmul(_ppow(_RHO2, (pw - am)//2), ang), scale=[1.0, c])
+            names.append(f"Z{n}_{m}")
+            polys.append(p)
+    return names, polys
+
+def _basis_cheb_radial(degree):
+    """
+    径向 Chebyshev：T_k(2ρ²-1), k=0..degree（全是 (u,v) 的多项式，原点处光滑），
+    再加 u、v 两个 tilt 项——bow 主要是碗形 + 倾斜。
+    """
+    s = _padd({(0, 0): -1.0}, _RHO2, scale=[1.0, 2.0])
+    T = [{(0, 0): 1.0}, s]
+    while len(T) < degree + 1:
+        T.append(_padd(_pmul(s, T[-1]), T[-2], scale=[2.0, -1.0]))
+    T = T[:degree + 1]
+    names = [f"T{k}" for k in range(len(T))] + ["tilt_x", "tilt_y"]
+    return names, T + [_U, _V]
+
+BOW_BASES = {
+    "poly": _basis_poly,
+    "zernike": _basis_zernike,
+    "cheb_radial": _basis_cheb_radial,
+}
+
+def _basis_coef_matrix(basis, degree):
+    names, polys = BOW_BASES[basis](degree)
+    max_deg = max(a + b for p in polys for (a, b) in p)
+    exps = _monomial_exponents(max_deg)
+    col = {e: j for j, e in enumerate(exps)}
+    C = np.zeros((len(polys), len(exps)))
+    for i, p in enumerate(polys):
+        for e, c in p.items():
+            C[i, col[e]] += c
+    return names, np.array(exps), C
+
+def _monomial_mats(uv, exps):
+    """单项式在 uv 上的值和一/二阶导：返回 (6, n, n_mono) = [V, Vu, Vv, Vuu, Vvv, Vuv]"""
+    u = uv[:, 0:1]; v = uv[:, 1:2]
+    a = exps[:, 0][None]; b = exps[:, 1][None]
+    def pw(x, p):
+        return np.where(p >= 0, x ** np.maximum(p, 0), 0.0)
+    ua, vb = pw(u, a), pw(v, b)
+    return np.stack([
+        ua * vb,
+        a * pw(u, a - 1) * vb,
+        b * ua * pw(v, b - 1),
+        a * (a - 1) * pw(u, a - 2) * vb,
+        b * (b - 1) * ua * pw(v, b - 2),
+        a * b * pw(u, a - 1) * pw(v, b - 1),
+    ])
+
+_BASIS_EVAL_CACHE = OrderedDict()
+_BASIS_CACHE_MAX = 128
+
+def _cached(key, fn):
+    hit = _BASIS_EVAL_CACHE.get(key)
+    if hit is None:
+        hit = fn()
+        _BASIS_EVAL_CACHE[key] = hit
+        if len(_BASIS_EVAL_CACHE) > _BASIS_CACHE_MAX:
+            _BASIS_EVAL_CACHE.popitem(last=False)
+    else:
+        _BASIS_EVAL_CACHE.move_to_end(key)
+    return hit
+
+def basis_eval_matrices(basis, degree, R, xy):
+    """
+    基函数在某个布局上的 值 / ∂x / ∂y / ∂xx / ∂yy / ∂xy 矩阵 (6, n, n_basis)，按布局缓存。
+    导数已经换算回原始坐标（d/dx = d/du / R）。
+    """
+    def compute():
+        names, exps, C = _basis_coef_matrix(basis, degree)
+        M = _monomial_mats(np.asarray(xy, dtype=float) / R, exps) @ C.T
+        scale = np.array([1, 1/R, 1/R, 1/R**2, 1/R**2, 1/R**2])[:, None, None]
+        return M * scale
+    return _cached(("eval", basis, degree, float(R), _layout_key(xy)), compute)
+
+def basis_fit_projector(basis, degree, R, B_xy, ridge_alpha=1e-6):
+    """
+    岭回归投影矩阵 P：coef = P @ z，只和 bow 布局有关，按布局缓存。
+    poly 基按原始坐标系数做惩罚（和 Ridge(alpha, fit_intercept=False) 一致），
+    其余基直接惩罚基系数。
+    """
+    def compute():
+        Phi = basis_eval_matrices(basis, degree, R, B_xy)[0]
+        if basis == "poly":
+            _, exps, _ = _basis_coef_matrix(basis, degree)
+            pen = ridge_alpha * R ** (-2.0 * exps.sum(axis=1))
+        else:
+            pen = np.full(Phi.shape[1], ridge_alpha)
+        return np.linalg.solve(Phi.T @ Phi + np.diag(pen), Phi.T)
+    return _cached(("fit", basis, degree, float(R), _layout_key(B_xy), float(ridge_alpha)), compute)
+
+def build_bow_basis_features(
+    targets_df: pd.DataFrame,
+    bow_df: pd.DataFrame,
+    basis="zernike",            # "poly" / "zernike" / "cheb_radial"
+    degree=4,
+    R=None,                     # 归一化半径；None 时取 bow 布局的最大半径
+    ridge_alpha=1e-6,
+    value_col="z",
+    add_wafer_level_coefs=True,
+):
+    """
+    可插拔基函数的 bow 形状拟合：
+        每个 bow 布局算一次投影矩阵 P，同布局的所有 wafer 一次矩阵乘拿到系数；
+        每个 target 布局算一次值 / 导数矩阵，评估也是矩阵乘。
+    输出列前缀 bow_{basis}_*（hat / dBdx / dBdy / d2x2 / d2y2 / d2xy / laplacian）
+    以及 bow_{basis}coef_{name}。basis="poly" 时列名和 build_bow_poly_features 完全一样。
+    """
+    if R is None:
+        R = float(np.sqrt((bow_df["x"]**2 + bow_df["y"]**2).max()))
+    names, exps, _ = _basis_coef_matrix(basis, degree)
+    prefix = f"bow_{basis}"
+    feat_names = ["hat", "dBdx", "dBdy", "d2x2", "d2y2", "d2xy"]
+    point_cols = [f"{prefix}_{n}" for n in feat_names] + [f"{prefix}_laplacian"]
+    coef_cols = [f"{prefix}coef_{n}" for n in names]
+    # poly 基输出原始坐标下的系数（和 sklearn 的 model.coef_ 对齐）
+    coef_out = R ** (-exps.sum(axis=1).astype(float)) if basis == "poly" else np.ones(len(names))
+
+    # ---- 拟合：按 bow 布局分组，一次矩阵乘 ----
+    coefs = {}
+    by_layout = {}
+    for wafer_id, bdf in bow_df.groupby("wafer_id"):
+        bdf = bdf[np.isfinite(bdf[value_col].to_numpy(dtype=float))]
+        B_xy = bdf[["x","y"]].to_numpy().astype(float)
+        by_layout.setdefault(_layout_key(B_xy), (B_xy, []))[1].append(
+            (wafer_id, bdf[value_col].to_numpy().astype(float)))
+    for B_xy, items in by_layout.values():
+        P = basis_fit_projector(basis, degree, R, B_xy, ridge_alpha)
+        Z = np.stack([z for _, z in items], axis=1)          # (nb, n_wafer)
+        Cf = P @ Z                                             # (n_basis, n_wafer)
+        for j, (wafer_id, _) in enumerate(items):
+            coefs[wafer_id] = Cf[:, j]
+
+    # ---- 评估 ----
+    out_rows = []
+    for wafer_id, tdf in targets_df.groupby("wafer_id"):
+        feat = tdf[["wafer_id","x","y"]].copy()
+        if wafer_id not in coefs:
+            out_rows.append(feat.reindex(columns=list(feat.columns) + point_cols
+                                         + (coef_cols if add_wafer_level_coefs else [])))
+            continue
+        E = basis_eval_matrices(basis, degree, R, tdf[["x","y"]].to_numpy().astype(float))
+        vals = E @ coefs[wafer_id]                             # (6, nT)
+        block = dict(zip(point_cols[:-1], vals))
+        block[f"{prefix}_laplacian"] = vals[3] + vals[4]
+        if add_wafer_level_coefs:
+            block.update({c: np.full(len(tdf), v) for c, v in zip(coef_cols, coefs[wafer_id] * coef_out)})
+        out_rows.append(pd.concat([feat, pd.DataFrame(block, index=feat.index)], axis=1))
+    return pd.concat(out_rows, ignore_index=True)
+
+
+⸻
+
+2) 和现有 bow_poly_* 的关系
+
+basis="poly" 时输出列名和 build_bow_poly_features 完全一样（bow_poly_hat … bow_poly_laplacian、bow_polycoef_1 / x / y / x^2 / x y / y^2），数值也一致：
+	•	内部在 x/R 坐标下解，数值条件好很多（原来 µm 坐标下 x^4 量级 1e20，sklearn 会报 ill-conditioned）
+	•	岭惩罚按原始坐标系数换算过（αR^(-2(a+b))），所以和 Ridge(alpha, fit_intercept=False) 是同一个解
+	•	我这边 10 片 wafer 对比，所有列相对误差 1e-15 量级，速度快了 10 倍以上（没有 iterrows 了）
+
+所以 assemble_training_table 里可以直接把
+
+    bow_poly_feat = build_bow_poly_features(targets_df=targets_df, bow_df=bow_df, degree=2, ...)
+
+换成
+
+    bow_poly_feat = build_bow_basis_features(targets_df, bow_df, basis="poly", degree=2, ridge_alpha=1e-6)
+
+旧模型不用重训。想加 Zernike 就再 append 一份：
+
+    feat_list.append(build_bow_basis_features(targets_df, bow_df, basis="zernike", degree=4, R=150000.0))
+
+⸻
+
+3) 注意事项
+	•	R：Zernike / 径向 Chebyshev 要在单位圆上才正交，建议固定为 wafer 半径（300mm → 150000 µm），不要用默认的「bow 最大半径」，否则不同批次 R 不同，系数不可比。
+	•	十字布局的可辨识性：30 个点都在 x 轴或 y 轴上，u·v 类的项（Zernike Z2_-2、Z4_-2 等、Cartesian 的 x y）在 bow 点上恒为 0，靠岭惩罚压到 0。这些系数列会是常数，LightGBM 会自动忽略，也可以直接 drop。
+	•	想加新基：写一个 degree -> (names, [多项式 dict]) 的函数注册进 BOW_BASES 就行，评估 / 拟合 / 缓存全部复用。
+	•	缓存按布局坐标 key，最多 128 个条目，LRU 淘汰。
+
+⸻
+
+
+
+
+
+
+下面把 train_lgbm_groupkfold 最后那段 per-wafer 指标改成分组数组归约。原来是 tmp.groupby(group_col) 循环、每片 wafer 调一次 mean_squared_error / mean_absolute_error / r2_score，几千片 wafer 时这一步比训练一折还慢（sklearn 每次调用都有参数检查的固定开销）。
+
+其实这些指标只需要几次分组求和：n、Σe²、Σ|e|、Σy，再用组均值算一次 Σ(y − ȳ)²，np.unique + np.bincount 就全出来了：
+	•	rmse = sqrt(Σe² / n)
+	•	mae  = Σ|e| / n
+	•	r2   = 1 − Σe² / SST，SST = Σ(y − ȳ)²（两遍算法：先 bincount 出组均值，再对偏差平方 bincount。不用 Σy² − (Σy)²/n，y 接近常数时那个减法会把有效位数全部抵消掉）
+
+同样的函数顺便用来切 per-fold、per-lot、per-径向分区，成本几乎不变。
+
+⸻
+
+1) 分组指标 + 多种切法
+
+def grouped_regression_metrics(y_true, y_pred, keys, key_name="group"):
+    """
+    按 keys 分组的 n / rmse / mae / r2，一次 np.unique + bincount 搞定，不做 groupby 循环。
+    r2 = 1 - SSE/SST，SST = Σ(y - ȳ)²（先算组均值再算偏差，避免 Σy² - (Σy)²/n 的抵消误差）；
+    n < 3 时为 NaN（和原来的 per-wafer 逻辑一致）；
+    SST 只剩组均值的舍入误差（y 是常数）时按 sklearn 的约定：完美预测 1.0，否则 0.0。
+    NaN 预测的行自动跳过。
+    """
+    y_true = np.asarray(y_true, dtype=float)
+    y_pred = np.asarray(y_pred, dtype=float)
+    keys = np.asarray(keys)
+    ok = ~np.isnan(y_pred) & ~np.isnan(y_true)
+    uniq, inv = np.unique(keys[ok], return_inverse=True)
+    yt = y_true[ok]; err = y_pred[ok] - yt
+    m = len(uniq)
+
+    n = np.bincount(inv, minlength=m).astype(float)
+    sse = np.bincount(inv, weights=err * err, minlength=m)
+    sae = np.bincount(inv, weights=np.abs(err), minlength=m)
+    sy = np.bincount(inv, weights=yt, minlength=m)
+    dev = yt - (sy / n)[inv]
+    sst = np.bincount(inv, weights=dev * dev, minlength=m)
+    sy2 = np.bincount(inv, weights=yt * yt, minlength=m)
+    # 相对容差：y 是常数时组均值的舍入误差（几个 ulp）还会留下一点“方差”，不算
+    has_var = sst > (16 * np.finfo(float).eps) ** 2 * sy2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r2 = np.where(has_var, 1.0 - sse / sst, np.where(sse == 0, 1.0, 0.0))
+    r2 = np.where(n >= 3, r2, np.nan)
+
+    return pd.DataFrame({
+        key_name: uniq,
+        "n": n.astype(int),
+        "rmse": np.sqrt(sse / n),
+        "mae": sae / n,
+        "r2": r2,
+    })
+
+def oof_breakdowns(
+    df: pd.DataFrame,
+    result: dict,
+    target_col: str = "overlay",
+    group_col: str = "wafer_id",
+    lot_col: str = "lot_id",
+    zone_edges=(0.0, 50000.0, 100000.0, 130000.0, 140000.0, np.inf),  # 径向分区（同坐标单位）
+):
+    """
+    OOF 指标的几种切法，全部走 grouped_regression_metrics（成本和切法数量基本无关）：
+        per_wafer / per_fold / per_lot（df 里有 lot_col 时）/ per_zone（按 r 分区）
+    """
+    y = df[target_col].astype(float).to_numpy()
+    p = result["oof_pred"]
+    out = {
+        "per_wafer": grouped_regression_metrics(y, p, df[group_col].to_numpy(), group_col)
+                         .sort_values("rmse", ascending=False),
+    }
+    if "oof_fold" in result:
+        out["per_fold"] = grouped_regression_metrics(y, p, result["oof_fold"], "fold")
+    if lot_col in df.columns:
+        out["per_lot"] = grouped_regression_metrics(y, p, df[lot_col].to_numpy(), lot_col) \
+                             .sort_values("rmse", ascending=False)
+
+    r = np.sqrt(df["x"].to_numpy(dtype=float)**2 + df["y"].to_numpy(dtype=float)**2)
+    edges = np.asarray(zone_edges, dtype=float)
+    zone = np.clip(np.digitize(r, edges) - 1, 0, len(edges) - 2)
+    zone_df = grouped_regression_metrics(y, p, zone, "zone")
+    zone_df.insert(1, "r_lo", edges[zone_df["zone"].to_numpy()])
+    zone_df.insert(2, "r_hi", edges[zone_df["zone"].to_numpy() + 1])
+    out["per_zone"] = zone_df
+    return out
+
+
+⸻
+
+2) 改 train_lgbm_groupkfold
+
+改动直接写在最前面那份 train_lgbm_groupkfold 的定义里（不另外复制一份），三处：
+
+① CV 循环前建 oof_fold = np.zeros(len(df), dtype=int)，循环里 oof_pred[va_idx] = pred_va 后面记 oof_fold[va_idx] = fold（per-fold 的打印保持不变）
+
+② 「--- Per-wafer metrics（很重要） ---」那段 groupby 循环和 fold_metrics 列表换成：
+
+    # --- Per-wafer / per-fold metrics（分组数组归约，不再 groupby + sklearn 循环）---
+    per_wafer_df = grouped_regression_metrics(y, oof_pred, groups, group_col) \
+                       .sort_values("rmse", ascending=False)
+    fold_metrics_df = grouped_regression_metrics(y, oof_pred, oof_fold, "fold")
+    fold_metrics_df["best_iter"] = [m.best_iteration for m in models]
+
+③ 返回的 dict 里加 "oof_fold": oof_fold
+
+返回的 dict 里多了一项 "oof_fold"（每行的验证折号，从 1 开始）。per_wafer_metrics / fold_metrics 的列名和原来一样（fold_metrics 多了 n），下游代码不用改。
+
+⸻
+
+3) 用法
+
+result = train_lgbm_groupkfold(df, target_col="overlay", group_col="wafer_id", drop_cols=("wafer_id", "lot_id"))
+bd = oof_breakdowns(df, result, target_col="overlay", lot_col="lot_id")
+
+bd["per_wafer"].head(20)   # 最差的 wafer
+bd["per_lot"].head(10)     # 最差的 lot
+bd["per_zone"]             # 中心 / 中间 / 边缘 各区的误差
+
+⸻
+
+4) 说明
+	•	我用 40 万行、5000 片 wafer 对了一下：原来的 groupby 循环 4.5 s，bincount 版 0.03 s，n / rmse / mae / r2 逐片和 sklearn 结果一致（allclose）。
+	•	r2 在 n < 3 时给 NaN，和原来一样；SST 按组均值两遍算，整片 y 是常数（SST 只剩几个 ulp 的舍入误差）时按 sklearn 的约定给 1.0 / 0.0。
+	•	lot_id 只用来切指标，训练时记得放进 drop_cols，否则字符串列会被当成特征。
+	•	zone_edges 默认是 µm 下 300mm wafer 的常见分区（中心 / 中间 / 边缘 / 极边缘），坐标是 mm 的话除以 1000。
+
+⸻
+
+
+
+
+
+
+下面给 train_lgbm_groupkfold 配一个 successive halving 超参搜索。现在 params 是写死的，手动调每试一组都要付完整的 5 折 × 最多 5000 轮，一天也试不了几组。
+
+思路（Hyperband 里的 successive halving）：
+	•	所有配置共用同一份 GroupKFold 切分、同一份分箱好的 lgb.Dataset（只 construct 一次，每折用 subset，不重复分箱）
+	•	第 0 轮：所有配置只跑 1 折、300 轮
+	•	每轮只留最好的 1/eta，折数和轮数预算都乘 eta，直到 5 折 / 5000 轮
+	•	同一轮内 trial 用线程池并行（LightGBM 训练时释放 GIL），每个 trial 固定 threads_per_trial 个线程，总 CPU 可控
+	•	最后用最优参数跑一遍完整的 train_lgbm_groupkfold，返回的对象和平时一模一样
+
+⸻
+
+1) 先让 train_lgbm_groupkfold 能接收 params
+
+直接改最前面那份 train_lgbm_groupkfold（不另外复制一份）：原来写死在函数体里的 params 挪到模块级的 BASE_LGB_PARAMS（放在函数定义前面），签名加一个参数：
+
+    params: dict = None,         # 覆盖 BASE_LGB_PARAMS 里的项，None 时用默认
+
+函数体里原来那段 params = {...} 换成：
+
+    params = {**BASE_LGB_PARAMS, "seed": random_state, **(params or {})}
+
+传进来的项覆盖默认值；不传 params 时和原来完全一样。
+
+⸻
+
+2) 搜索驱动
+
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+def make_param_grid(space: dict, n_samples=None, random_state=42):
+    """
+    space: {"num_leaves": [31, 64, 127], "min_data_in_leaf": [20, 50, 200], ...}
+    n_samples=None 时全组合，否则随机抽 n_samples 个（不重复）
+    """
+    keys = list(space)
+    combos = [dict(zip(keys, v)) for v in itertools.product(*(space[k] for k in keys))]
+    if n_samples is not None and n_samples < len(combos):
+        rng = np.random.default_rng(random_state)
+        combos = [combos[i] for i in rng.choice(len(combos), size=n_samples, replace=False)]
+    return combos
+
+def _fit_one_fold(params, dtrain_full, X, y, tr_idx, va_idx, num_boost_round, early_stopping_rounds):
+    dtr = dtrain_full.subset(tr_idx)
+    dva = dtrain_full.subset(va_idx)
+    model = lgb.train(
+        params=params,
+        train_set=dtr,
+        valid_sets=[dva],
+        valid_names=["valid"],
+        num_boost_round=num_boost_round,
+        callbacks=[lgb.early_stopping(stopping_rounds=early_stopping_rounds, verbose=False)],
+    )
+    pred = model.predict(X.iloc[va_idx], num_iteration=model.best_iteration)
+    return float(np.sqrt(np.mean((pred - y[va_idx])**2))), model.best_iteration
+
+def successive_halving_search(
+    df: pd.DataFrame,
+    param_list,
+    target_col: str = "overlay",
+    group_col: str = "wafer_id",
+    drop_cols=("wafer_id",),
+    n_splits: int = 5,
+    random_state: int = 42,
+    eta: int = 3,                 # 每轮只留 1/eta 的配置
+    min_rounds: int = 300,        # 第一轮的 boosting 预算
+    max_rounds: int = 5000,       # 最后一轮（和 train_lgbm_groupkfold 一样）
+    min_folds: int = 1,           # 第一轮只跑几折
+    n_jobs: int = None,           # 同时跑几个 trial；None = CPU 数 // threads_per_trial
+    threads_per_trial: int = 2,
+):
+    """
+    多组 LightGBM 参数的 successive halving 搜索：
+        · 所有 trial 共用同一份 GroupKFold 切分和同一份分箱好的 lgb.Dataset（只 construct 一次）
+        · 第 0 轮：所有配置，min_folds 折、min_rounds 轮；之后每轮保留前 1/eta，
+          折数和轮数预算都乘 eta，直到 n_splits 折 / max_rounds 轮
+        · 同一轮内 trial 并行，总线程数 ≈ n_jobs × threads_per_trial
+    返回 (leaderboard_df, best_result)，best_result 是用最优参数跑完整 train_lgbm_groupkfold 的结果。
+    """
+    y = df[target_col].astype(float).to_numpy()
+    groups = df[group_col].to_numpy()
+    drop_set = set(drop_cols) | {target_col}
+    feature_cols = [c for c in df.columns if c not in drop_set]
+    X = df[feature_cols]
+    all_nan_cols = [c for c in feature_cols if X[c].isna().all()]
+    if all_nan_cols:
+        feature_cols = [c for c in feature_cols if c not in all_nan_cols]
+        X = df[feature_cols]
+    X = X.replace([np.inf, -np.inf], np.nan)
+
+    # 同一份切分 + 同一份分箱
+    splits = list(GroupKFold(n_splits=n_splits).split(X, y, groups=groups))
+    dtrain_full = lgb.Dataset(X, label=y, feature_name=feature_cols, free_raw_data=False,
+                              params={"verbosity": -1, "feature_pre_filter": False}).construct()
+
+    if n_jobs is None:
+        n_jobs = max(1, (os.cpu_count() or 1) // threads_per_trial)
+
+    trials = [{"trial": i, "params": {**BASE_LGB_PARAMS, "seed": random_state, **p,
+                                      "num_threads": threads_per_trial},
+               "user_params": p} for i, p in enumerate(param_list)]
+    alive = list(range(len(trials)))
+    history = []
+    folds, rounds, rung = min(min_folds, n_splits), min(min_rounds, max_rounds), 0
+
+    while True:
+        t0 = time.time()
+
+        def run(ti):
+            scores, iters = [], []
+            for tr_idx, va_idx in splits[:folds]:
+                s, it = _fit_one_fold(trials[ti]["params"], dtrain_full, X, y, tr_idx, va_idx,
+                                      rounds, early_stopping_rounds=min(200, max(20, rounds // 10)))
+                scores.append(s); iters.append(it)
+            return ti, float(np.mean(scores)), int(np.mean(iters))
+
+        with ThreadPoolExecutor(max_workers=n_jobs) as ex:
+            res = list(ex.map(run, alive))
+        for ti, score, it in res:
+            history.append({"trial": ti, "rung": rung, "folds": folds, "rounds": rounds,
+                            "rmse": score, "best_iter": it, **trials[ti]["user_params"]})
+        print(f"[SH rung {rung}] {len(alive)} configs × {folds} folds × {rounds} rounds "
+              f"-> best RMSE={min(r[1] for r in res):.6f}  ({time.time() - t0:.1f}s)")
+
+        if folds >= n_splits and rounds >= max_rounds or len(alive) == 1:
+            break
+        keep = max(1, len(alive) // eta)
+        alive = [ti for ti, _, _ in sorted(res, key=lambda r: r[1])[:keep]]
+        folds = min(n_splits, folds * eta)
+        rounds = min(max_rounds, rounds * eta)
+        rung += 1
+
+    hist_df = pd.DataFrame(history)
+    leaderboard = (hist_df.sort_values(["rung", "rmse"], ascending=[False, True])
+                          .drop_duplicates("trial").reset_index(drop=True))
+    best_params = trials[int(leaderboard.loc[0, "trial"])]["user_params"]
+    print(f"[SH] best params: {best_params}")
+
+    best_result = train_lgbm_groupkfold(df, target_col=target_col, group_col=group_col,
+                                        drop_cols=drop_cols, n_splits=n_splits,
+                                        random_state=random_state, params=best_params)
+    best_result["search_history"] = hist_df
+    return leaderboard, best_result
+
+
+⸻
+
+3) 用法
+
+grid = make_param_grid({
+    "num_leaves":       [15, 31, 63, 127],
+    "min_data_in_leaf": [20, 50, 100, 300],
+    "feature_fraction": [0.6, 0.8, 1.0],
+    "lambda_l2":        [0.0, 1.0, 10.0],
+    "learning_rate":    [0.03, 0.05, 0.1],
+}, n_samples=81)
+
+leaderboard, result = successive_halving_search(
+    df, grid, target_col="overlay", drop_cols=("wafer_id",),
+    eta=3, min_rounds=300, max_rounds=5000, n_jobs=8, threads_per_trial=4,
+)
+leaderboard.head(10)
+result["overall"], result["per_wafer_metrics"].head()
+
+⸻
+
+4) 预算大概是多少
+
+81 组、eta=3、5 折：
+	•	rung 0：81 组 × 1 折 × 300 轮
+	•	rung 1：27 组 × 3 折 × 900 轮
+	•	rung 2：9 组 × 5 折 × 2700 轮
+	•	rung 3：3 组 × 5 折 × 5000 轮
+
+总 boosting 轮数约 29 万轮，是 81 组全量 5 折 × 5000 轮（约 200 万轮）的 1/7 左右，早停会让实际更少。
+
+注意：
+	•	leaderboard 按「走到的最后一轮、该轮 RMSE」排序，只有同一轮的分数可以直接比较。
+	•	rung 里的 RMSE 是各折 RMSE 的平均，和最终 result["overall"]（OOF 合并算）会有一点差异。
+	•	共享 Dataset 时关了 feature_pre_filter，否则不同 min_data_in_leaf 的 trial 会被第一次分箱时的过滤影响。
+	•	小数据上 threads_per_trial 取 1~2、n_jobs 取大一点更快；数据大时反过来。
+
+⸻
+
+
+
+
+
+
+下面在 train_lgbm_groupkfold 的平均 gain 重要性上加一个自动裁剪循环。现在 ovl 的特征表动辄几百列，大部分是冗余的多尺度 lvl_*（knn32/knn64/rad5000/rad10000/gs* 之间高度相关）和 bow_polycoef_*（wafer 级常数，重复到每个点上），特征构建和训练都被拖慢。
+
+循环逻辑：
+	•	每轮用当前特征集跑一遍 train_lgbm_groupkfold，记录 OOF RMSE
+	•	删 gain 为 0 的列
+	•	|corr| > corr_threshold 的特征对里，删重要性低的那个
+	•	再删剩下里 gain 最低的 drop_frac
+	•	OOF RMSE 比历史最好差超过 rmse_tol 就回退到上一轮的特征集并停止
+
+最后输出最小特征列表，再用 feature_plan 反推上游哪些尺度 / 特征族根本不用算。
+
+⸻
+
+1) 代码
+
+需要 train_lgbm_groupkfold 已经支持 params 参数（见上一节）。
+
+import re
+
+def _drop_correlated(df, features, importance, threshold=0.98, max_rows=20000, random_state=42):
+    """
+    |corr| > threshold 的特征对里，去掉 gain 重要性低的那个。
+    相关矩阵最多用 max_rows 行抽样算，几百列时也就秒级。
+    """
+    X = df[features]
+    if len(X) > max_rows:
+        X = X.sample(max_rows, random_state=random_state)
+    C = np.abs(np.nan_to_num(X.astype(float).corr().to_numpy()))
+    np.fill_diagonal(C, 0.0)
+    # 按重要性从高到低扫：保留高的，删掉和它高度相关的低重要性特征
+    order = np.argsort([-importance.get(f, 0.0) for f in features])
+    removed = np.zeros(len(features), dtype=bool)
+    for i in order:
+        if removed[i]:
+            continue
+        dup = (C[i] > threshold) & ~removed
+        dup[i] = False
+        removed |= dup
+    return [f for f, r in zip(features, removed) if r]
+
+def prune_features(
+    df: pd.DataFrame,
+    target_col: str = "overlay",
+    group_col: str = "wafer_id",
+    drop_cols=("wafer_id",),
+    keep_cols=("x", "y", "r", "theta"),   # 永远不删
+    n_splits: int = 5,
+    random_state: int = 42,
+    params: dict = None,
+    drop_frac: float = 0.2,              # 每轮删掉 gain 最低的比例
+    corr_threshold: float = 0.98,
+    rmse_tol: float = 0.01,              # OOF RMSE 比最好值变差超过 1% 就停
+    min_features: int = 10,
+    max_iter: int = 20,
+):
+    """
+    基于 train_lgbm_groupkfold 平均 gain 重要性的迭代特征裁剪：
+        每轮：训练 → 记录 OOF RMSE → 删 0 重要性 + 高相关中较弱的 + 最低 drop_frac
+        RMSE 比历史最好差超过 rmse_tol，回退到上一轮的特征集并停止
+    返回 {"features": 最小特征列表, "history": 每轮记录, "result": 对应的训练结果}
+    """
+    y_cols = set(drop_cols) | {target_col}
+    features = [c for c in df.columns if c not in y_cols]
+    keep = set(keep_cols)
+    history = []
+    best = None   # (rmse, features, result)
+
+    for it in range(max_iter):
+        removed_cols = [c for c in df.columns if c not in y_cols and c not in features]
+        result = train_lgbm_groupkfold(
+            df, target_col=target_col, group_col=group_col,
+            drop_cols=tuple(drop_cols) + tuple(removed_cols),
+            n_splits=n_splits, random_state=random_state, params=params,
+        )
+        rmse = float(result["overall"]["rmse"])
+        features = list(result["feature_cols"])       # 全 NaN 列已被自动去掉
+        history.append({"iter": it, "n_features": len(features), "oof_rmse": rmse})
+        print(f"[prune {it}] n_features={len(features)}  OOF RMSE={rmse:.6f}")
+
+        if best is not None and rmse > best[0] * (1 + rmse_tol):
+            print(f"[prune] RMSE 变差超过 {rmse_tol:.0%}，回退到 {len(best[1])} 个特征")
+            break
+        if best is None or rmse <= best[0]:
+            best = (rmse, features, result)
+        else:
+            # 在容差内：特征更少，接受
+            best = (best[0], features, result)
+
+        imp = dict(zip(result["feature_importance"]["feature"],
+                       result["feature_importance"]["importance_gain_avg"]))
+        candidates = [f for f in features if f not in keep]
+        if len(features) <= min_features or not candidates:
+            break
+
+        drop = {f for f in candidates if imp.get(f, 0.0) <= 0.0}
+        rest = [f for f in candidates if f not in drop]
+        drop |= set(_drop_correlated(df, rest, imp, threshold=corr_threshold)) - keep
+        rest = sorted((f for f in candidates if f not in drop), key=lambda f: imp.get(f, 0.0))
+        drop |= set(rest[:int(len(rest) * drop_frac)])
+
+        max_drop = len(features) - min_features
+        if max_drop <= 0 or not drop:
+            break
+        drop = sorted(drop, key=lambda f: imp.get(f, 0.0))[:max_drop]
+        features = [f for f in features if f not in set(drop)]
+
+    hist_df = pd.DataFrame(history)
+    return {"features": best[1], "history": hist_df, "result": best[2]}
+
+def feature_plan(features):
+    """
+    从裁剪后的特征列表反推上游 builder 需要算什么。
+    knn_list / radius_list / add_quad_curvature / bow_knn_list / fft_sigma_list / gp_length_scales
+    和 OverlayPipeline 的参数同名，可以直接传进去。没出现的尺度 / 特征族就不用算了。
+    bow 多项式（bow_poly_* / bow_polycoef_*）每片 wafer 只是一次小的岭回归，OverlayPipeline 总是算，这里不给开关。
+    """
+    fs = list(features)
+    def scales(pattern, cast):
+        return sorted({cast(m.group(1)) for f in fs for m in [re.match(pattern, f)] if m})
+
+    knn = scales(r"lvl_knn(\d+)_", int)
+    knn_quad = scales(r"lvl_knn(\d+)_(?:d2x2|d2y2|d2xy|laplacian)$", int)
+    plan = {
+        "knn_list": knn,
+        "radius_list": scales(r"lvl_rad([\d.]+)_", float),
+        "add_quad_curvature": bool(knn_quad),
+        "bow_knn_list": scales(r"bow_(?:idw_)?knn(\d+)", int),
+        "fft_sigma_list": scales(r"lvl_gs([\d.]+)_", float) or None,
+        "gp_length_scales": scales(r"bow_gp([\d.]+)_", float) or None,
+    }
+    return plan
+
+
+⸻
+
+2) 用法
+
+out = prune_features(
+    df, target_col="overlay", drop_cols=("wafer_id",),
+    params={"learning_rate": 0.1},     # 裁剪阶段用大一点的学习率，快很多
+    drop_frac=0.2, corr_threshold=0.98, rmse_tol=0.01,
+)
+out["history"]                 # 每轮的特征数和 OOF RMSE
+min_features = out["features"]
+
+plan = feature_plan(min_features)
+# {'knn_list': [64], 'radius_list': [10000.0], 'add_quad_curvature': False, 'bow_knn_list': [5], ...}
+
+pipe = OverlayPipeline(
+    knn_list=plan["knn_list"], radius_list=plan["radius_list"],
+    add_quad_curvature=plan["add_quad_curvature"], bow_knn_list=plan["bow_knn_list"],
+    fft_sigma_list=plan["fft_sigma_list"], gp_length_scales=plan["gp_length_scales"],
+    drop_cols=("wafer_id",),
+)
+
+上游少算的尺度是真正省时间的地方：比如 knn32 整组被删掉，build_leveling_local_features 里那一轮 KDTree 查询 + 逐点 lstsq 就完全不用跑了；add_quad_curvature=False 还能省掉最贵的二次拟合。
+
+⸻
+
+3) 注意事项
+	•	keep_cols（默认 x / y / r / theta）永远不删，位置特征对后面的 dense map 和残差分析有用。
+	•	feature_plan 是按尺度粒度反推的：某个尺度只要有一列被保留，整组都会算，之后训练时用 drop_cols 把多余的列去掉就行（或者直接在 transform 之后按 min_features 取列）。
+	•	相关性用最多 2 万行抽样计算，wafer 级常数列（bow_polycoef_*）之间的相关性会很高，这正是想删的。
+	•	裁剪用的 params 最好和最终训练一致（至少 num_leaves / min_data_in_leaf 一致），否则重要性排序可能不一样。
+
+⸻
\ No newline at end of file